@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Multi-pattern keyword matching (Aho-Corasick), case-insensitive, for the
+mixed CJK and Latin keyword lists of simple_scan.
+
+One pass over the text finds every term, so the cost does not grow with
+the number of terms. Uses pyahocorasick (C) if installed, a pure Python
+automaton otherwise.
+"""
+
+import sys
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+class Matcher():
+    """
+    >>> m = Matcher(["sex", "porn", "人妻", ".sucks", "exe"])
+    >>> sorted(m.findall("Free PORN and sexy 人妻"))
+    ['porn', 'sex', '人妻']
+    >>> sorted(m.findall("SEXE"))
+    ['exe', 'sex']
+    >>> m.search("who.sucks.com"), m.search("nothing here"), m.search(None)
+    (True, False, False)
+    >>> m.findall_many(["人妻", "", "xxx"])
+    [{'人妻'}, set(), set()]
+    """
+
+    def __init__(self, terms, native=True):
+        self.terms = sorted(set(i.lower() for i in terms if i))
+        self._automaton = None
+        if native and ahocorasick is not None:
+            self._automaton = ahocorasick.Automaton()
+            for term in self.terms:
+                self._automaton.add_word(term, term)
+            self._automaton.make_automaton()
+        else:
+            self._build()
+
+    def _build(self):
+        goto = [{}]
+        out = [()]
+        for term in self.terms:
+            state = 0
+            for ch in term:
+                if ch not in goto[state]:
+                    goto.append({})
+                    out.append(())
+                    goto[state][ch] = len(goto) - 1
+                state = goto[state][ch]
+            out[state] = (term,)
+
+        # breadth first, the fail state of a child is found from its parent's
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, child in goto[state].items():
+                queue.append(child)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[child] = goto[f].get(ch, 0)
+                out[child] += out[fail[child]]
+
+        self._goto, self._fail, self._out = goto, fail, out
+        self._alphabet = frozenset(ch for term in self.terms for ch in term)
+
+    def findall(self, text):
+        """the set of terms found in `text`"""
+        if not text:
+            return set()
+        text = text.lower()
+        if self._automaton is not None:
+            return set(term for _, term in self._automaton.iter(text))
+
+        goto, fail, out, alphabet = self._goto, self._fail, self._out, self._alphabet
+        found = set()
+        state = 0
+        for ch in text:
+            if ch not in alphabet:
+                state = 0
+                continue
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+    def search(self, text):
+        return bool(self.findall(text))
+
+    def findall_many(self, texts):
+        return [self.findall(i) for i in texts]
+
+
+def main(*terms):
+    """echo text | ./aho_corasick.py term ...    # or no terms for the doctests"""
+    if not terms:
+        import doctest
+        return doctest.testmod()
+    m = Matcher(terms)
+    for line in sys.stdin:
+        found = m.findall(line)
+        if found:
+            print(" ".join(sorted(found)), line, sep="\t", end="")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -6,7 +6,7 @@ import gc
 import sys
 import time
 
-import leveldb
+import parallel_scan
 
 N = 0
 T = int(time.time())
@@ -24,16 +24,15 @@ def f(k, v):
 
 
 def f(k, v):
-    if v.count("撸") > 3:
-        print(k)
+    if v.decode().count("撸") > 3:
+        return k
 
 
-def main():
-    db = leveldb.LevelDB('./homepages.2')
-    print(db.GetStats())
-    for k, v in db.RangeIter():
-        f(k.decode(), v.decode())
+def main(path="./homepages.2", workers=None):
+    for k in parallel_scan.scan(parallel_scan.LevelDBSource(path), f,
+                                workers and int(workers), ordered=True):
+        print(k)
 
 
 if __name__ == "__main__":
-    main()
+    main(*sys.argv[1:])
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+Records of crawl results, shared by the workers, the hub and the tools.
+
+A record is::
+
+    MAGIC, version (1 byte), dictionary id (1 byte), zlib stream
+
+The zlib stream is compressed with the preset dictionary `zdict/<id>`,
+trained on our own pages by `train` (id 0 means no dictionary). The
+newest dictionary found is used for encoding; all of them are needed for
+decoding, so never change or delete a published one, and give a new one
+to the hub before the workers.
+
+Values written before this are plain JSON/text or a bare zlib stream,
+`decode` passes them through.
+"""
+
+import collections
+import json
+import os
+import sys
+import zlib
+
+
+# media types of POST bodies: one record, or `frame`d ones; records are
+# compressed each on its own, the body as a whole is not deflate
+RECORD_TYPE = "application/x-robot2-record"
+RECORDS_TYPE = "application/x-robot2-records"
+LEVEL = 6
+MAGIC = b"\x00Z"
+VERSION = 1
+DICT_FOLDER = "zdict"
+DICT_SIZE = 32 * 1024  # zlib uses at most the last 32 KiB
+
+
+def _load_dicts(folder=DICT_FOLDER):
+    dicts = {0: b""}
+    if os.path.isdir(folder):
+        for fn in os.listdir(folder):
+            if fn.isdigit() and 0 < int(fn) < 256:
+                with open(os.path.join(folder, fn), "rb") as f:
+                    dicts[int(fn)] = f.read()
+    return dicts
+
+
+dicts = _load_dicts()
+dict_id = max(dicts)
+
+
+def _compress(data, zdict):
+    c = zlib.compressobj(LEVEL, zdict=zdict) if zdict else zlib.compressobj(LEVEL)
+    return c.compress(data) + c.flush()
+
+
+def encode(data: bytes) -> bytes:
+    return MAGIC + bytes([VERSION, dict_id]) + _compress(data, dicts[dict_id])
+
+
+def decode(record: bytes) -> bytes:
+    """
+    >>> decode(encode(b'{"pages":[]}'))
+    b'{"pages":[]}'
+    >>> decode(zlib.compress(b'{"pages":[]}'))
+    b'{"pages":[]}'
+    >>> decode(b'{"pages": []}')
+    b'{"pages": []}'
+    >>> decode(b'xxx')
+    b'xxx'
+    """
+
+    if record.startswith(MAGIC):
+        version, zdict_id = record[2], record[3]
+        if version != VERSION:
+            raise ValueError("unknown record version", version)
+        zdict = dicts[zdict_id]
+        d = zlib.decompressobj(zdict=zdict) if zdict else zlib.decompressobj()
+        return d.decompress(record[4:]) + d.flush()
+
+    if record[:1] == b"\x78":  # bare zlib stream, or text starting with "x"
+        try:
+            return zlib.decompress(record)
+        except zlib.error:
+            pass
+    return record
+
+
+def line(name: str, record: bytes) -> bytes:
+    """One result in a plain POST /host-info body, the JSON must be compact
+
+    >>> line("q.org", encode(b'{"pages":[]}'))
+    b'q.org\\t{"pages":[]}\\n'
+    """
+
+    return name.encode() + b"\t" + decode(record) + b"\n"
+
+
+def frame(name: str, record: bytes) -> bytes:
+    """One record in a RECORDS_TYPE POST /host-info body::
+
+        <name>\\t<length>\\n<record>
+    """
+
+    return "{}\t{}\n".format(name, len(record)).encode() + record
+
+
+def unframe(body: bytes):
+    """ValueError at a bad frame, nothing after it can be read
+
+    >>> body = frame("q.org", b"x\\ny") + frame("q.net", b"")
+    >>> list(unframe(body))
+    [('q.org', b'x\\ny'), ('q.net', b'')]
+    >>> list(unframe(body + b"q.com\\t-3\\nxxx"))
+    Traceback (most recent call last):
+    ...
+    ValueError: ('bad frame', 19)
+    """
+
+    i = 0
+    while i < len(body):
+        j = body.index(b"\n", i)
+        name, _, length = body[i:j].partition(b"\t")
+        if not 0 <= int(length) <= len(body) - j - 1:
+            raise ValueError("bad frame", i)
+        i, j = j + 1, j + 1 + int(length)
+        yield name.decode(), body[i:j]
+        i = j
+
+
+def batch(records, framed=True) -> (bytes, dict):
+    """Body and headers of POST /host-info for [(name, record), ...]
+
+    `framed` only if the hub `accepted` RECORDS_TYPE.
+    """
+
+    if framed:
+        body = b"".join(frame(name, record) for name, record in records)
+        return body, {"Content-Type": RECORDS_TYPE}
+    return b"".join(line(name, record) for name, record in records), {}
+
+
+def resend(records, status: int, body: bytes) -> list:
+    """The records to POST again, from the answer of POST /host-info: all of
+    them on 503, on 200 the "retry" ones the hub could not forward
+
+    >>> records = [("a.org", b"1"), ("b.org", b"2")]
+    >>> resend(records, 503, b""), resend(records, 200, b""), resend(records, 500, b"")
+    ([('a.org', b'1'), ('b.org', b'2')], [], [])
+    >>> resend(records, 200, b'{"retry": ["b.org"]}')
+    [('b.org', b'2')]
+    """
+
+    if status == 503:  # the hub is behind
+        return list(records)
+    if status == 200 and body:
+        retry = set(json.loads(body.decode())["retry"])
+        return [i for i in records if i[0] in retry]
+    return []
+
+
+def accepted(headers) -> bool:
+    """the hub takes records, from the "Accept-Post" of GET /host"""
+    return RECORDS_TYPE in headers.get("Accept-Post", "")
+
+
+def train(samples, size=DICT_SIZE, width=32, step=8,
+          sample_size=64 * 1024, max_pieces=1 << 19) -> bytes:
+    """Build a preset dictionary from the substrings most samples share
+
+    Counts each `width` bytes piece once per sample, the most common ones go
+    last, where zlib finds them with the shortest distances. Only the first
+    `sample_size` bytes of a sample are read, and when there are more than
+    `max_pieces` pieces the ones seen once are forgotten (the `max_pieces` / 2
+    most common kept if still too many), so memory does not grow with the
+    number of samples.
+
+    >>> samples = [b'<!DOCTYPE html><html><head><meta charset="utf-8"><title>%d</title>'
+    ...            b'</head><body></body></html>' % i for i in range(9)]
+    >>> len(train(samples, size=64))
+    64
+    >>> zdict = train(samples, max_pieces=8)  # the 4 pieces before the number
+    >>> len(zdict), b'<meta charset="utf-8">' in zdict
+    (128, True)
+    """
+
+    counter = collections.Counter()
+    for sample in samples:
+        sample = sample[:sample_size]
+        counter.update(set(sample[i:i + width]
+                           for i in range(0, len(sample) - width + 1, step)))
+        if len(counter) > max_pieces:  # forget the rarest
+            counter = collections.Counter({k: v for k, v in counter.items() if v > 1})
+            if len(counter) > max_pieces // 2:
+                counter = collections.Counter(dict(counter.most_common(max_pieces // 2)))
+
+    pieces = []
+    n = 0
+    for piece, cnt in counter.most_common():
+        if cnt < 2 or n + len(piece) > size:
+            break
+        pieces.append(piece)
+        n += len(piece)
+    return b"".join(reversed(pieces))
+
+
+def main(cmd=None, ldb=None, n=10000):
+    """
+    ./codec.py train hosts.ldb [n]   # writes zdict/<next id>
+    """
+
+    if cmd != "train":
+        import doctest
+        return doctest.testmod()
+
+    import itertools
+    import leveldb
+
+    db = leveldb.LevelDB(ldb)
+    samples = [decode(bytes(v)) for _, v in
+               itertools.islice(db.RangeIter(), int(n))]
+    zdict = train(samples)
+
+    new_id = dict_id + 1
+    if not os.path.isdir(DICT_FOLDER):
+        os.mkdir(DICT_FOLDER)
+    with open(os.path.join(DICT_FOLDER, str(new_id)), "wb") as f:
+        f.write(zdict)
+
+    before = sum(len(_compress(s, b"")) for s in samples)
+    after = sum(len(_compress(s, zdict)) for s in samples)
+    print(new_id, len(zdict), before, after)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+Crawl results as columns, for questions about the corpus (errors,
+encodings, "bad" flags, counts per suffix, ...) that should not decode
+every record of hosts.ldb.
+
+The hub adds a row per result to an `Exporter`, which writes them in
+parts of at most `PART_ROWS` rows, at least every `PART_INTERVAL`
+seconds: <folder>/<time>-<pid>-<n>.<ext>. The text of the first page goes
+to <time>-<pid>-<n>.text.<ext> beside it, read only when asked for.
+
+Parquet if pyarrow is installed, NumPy .npz otherwise. `load` reads the
+parts of either back, as columns:
+
+    >>> cols = load("export", ["err", "tail"])             # doctest: +SKIP
+    >>> collections.Counter(cols["err"]).most_common(10)   # doctest: +SKIP
+"""
+
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import domain_utils
+
+
+FORMAT = "parquet" if pyarrow else "npz" if numpy else None
+
+SCHEMA = [
+    ("name", str),
+    ("ts", int),
+    ("ip", str),
+    ("tail", str),
+    ("schema", str),
+    ("redirect", str),
+    ("err", str),
+    ("bad", bool),
+    ("n_pages", int),
+    ("code", int),
+    ("encoding", str),
+    ("title", str),
+    ("n_other_hosts", int),
+    ("n_images", int),
+]
+
+
+def row(name, info, ts=None, bad=None):
+    """the scalar fields of a result, and the text of its first page
+
+    >>> r, text = row("www.q.com.cn", {"pages": [{"code": 200, "text": "hi"}]}, ts=1)
+    >>> r["tail"], r["code"], r["n_pages"], r["err"], text
+    ('q.com.cn', 200, 1, None, 'hi')
+    """
+
+    pages = info.get("pages") or [{}]
+    page = pages[0]
+    return {
+        "name": name,
+        "ts": int(ts or time.time()),
+        "ip": info.get("ip"),
+        "tail": domain_utils.tail(name.partition(":")[0]),
+        "schema": info.get("schema"),
+        "redirect": info.get("redirect"),
+        "err": info.get("err"),
+        "bad": bad,
+        "n_pages": len(info.get("pages") or ()),
+        "code": page.get("code"),
+        "encoding": page.get("encoding"),
+        "title": page.get("title"),
+        "n_other_hosts": len(info.get("other_hosts_found") or ()),
+        "n_images": len(info.get("images") or ()),
+    }, page.get("text")
+
+
+def _npz_columns(k, values, type_):
+    """arrays of column `k`, strings as UTF-8 bytes "<k>.data" and the
+    ends of each one "<k>.ends": fixed width would take the longest page
+    text times the rows
+    """
+
+    if type_ is str:
+        encoded = [(v or "").encode() for v in values]
+        ends = numpy.cumsum([len(v) for v in encoded], dtype=numpy.int64)
+        data = numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+        return {k + ".data": data, k + ".ends": ends}
+    if type_ is bool:
+        return {k: numpy.array([bool(v) for v in values])}
+    return {k: numpy.array([-1 if v is None else v for v in values], dtype=numpy.int64)}
+
+
+def _npz_strings(data, ends):
+    """
+    >>> arrays = _npz_columns("s", ["ab", None, "人"], str)
+    >>> _npz_strings(arrays["s.data"], arrays["s.ends"]).tolist()
+    ['ab', '', '人']
+    """
+
+    data = data.tobytes()
+    out = numpy.empty(len(ends), dtype=object)
+    start = 0
+    for i, end in enumerate(ends.tolist()):
+        out[i] = data[start:end].decode()
+        start = end
+    return out
+
+
+_arrow_types = {str: "string", int: "int64", bool: "bool_"}
+
+
+def write(path, columns, fmt=FORMAT):
+    """`columns`: {name: (type, values)}, written to `path` + "." + `fmt`"""
+    tmp = "{}.tmp.{}".format(path, fmt)
+    if fmt == "parquet":
+        table = pyarrow.table({k: pyarrow.array(v, getattr(pyarrow, _arrow_types[t])())
+                               for k, (t, v) in columns.items()})
+        pyarrow.parquet.write_table(table, tmp, compression="zstd")
+    else:
+        arrays = {}
+        for k, (t, v) in columns.items():
+            arrays.update(_npz_columns(k, v, t))
+        with open(tmp, "wb") as f:
+            numpy.savez_compressed(f, **arrays)
+    os.replace(tmp, "{}.{}".format(path, fmt))  # readers never see half a part
+
+
+class Exporter():
+    PART_ROWS = 50000
+    PART_INTERVAL = 60
+
+    def __init__(self, folder, fmt=FORMAT):
+        if fmt is None:
+            raise ImportError("columns needs pyarrow or numpy")
+        self.folder = folder
+        self.fmt = fmt
+        self._rows = []
+        self._texts = []
+        self._started = time.time()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+
+    def add(self, name, info, **kwargs):
+        self.add_row(*row(name, info, **kwargs))
+
+    def add_row(self, r, text):
+        with self._lock:
+            self._rows.append(r)
+            self._texts.append((r["name"], text))
+            full = len(self._rows) >= self.PART_ROWS
+        if full:
+            self.flush(force=True)
+
+    def flush(self, force=False):
+        with self._lock:
+            if not self._rows or \
+                    not force and time.time() - self._started < self.PART_INTERVAL:
+                return
+            rows, self._rows = self._rows, []
+            texts, self._texts = self._texts, []
+            self._started = time.time()
+            seq = next(self._seq)
+
+        path = os.path.join(self.folder, "{}-{}-{}".format(
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(), seq))
+        write(path, {k: (t, [r[k] for r in rows]) for k, t in SCHEMA}, self.fmt)
+        write(path + ".text", {"name": (str, [n for n, _ in texts]),
+                               "text": (str, [t for _, t in texts])}, self.fmt)
+
+
+def parts(folder, text=False):
+    for fn in sorted(os.listdir(folder)):
+        base, _, ext = fn.rpartition(".")
+        if ext in ("parquet", "npz") and ".tmp" not in base and \
+                base.endswith(".text") == text:
+            yield os.path.join(folder, fn), ext
+
+
+def load(folder, columns=None, text=False):
+    """{column: numpy array or list} of all the parts in `folder`
+
+    `text=True` for the "name" and "text" columns of the text parts.
+    Missing values are null (NaN for numbers) in Parquet, "" or -1 in .npz.
+    """
+
+    out = collections.defaultdict(list)
+    for path, ext in parts(folder, text):
+        if ext == "parquet":
+            table = pyarrow.parquet.read_table(path, columns=columns)
+            for k in table.column_names:
+                out[k].append(table.column(k).to_numpy(zero_copy_only=False)
+                              if numpy else table.column(k).to_pylist())
+        else:
+            with numpy.load(path) as npz:
+                names = [i.rpartition(".")[0] if i.endswith((".data", ".ends")) else i
+                         for i in npz.files]
+                for k in columns or dict.fromkeys(names):
+                    if k in npz.files:
+                        out[k].append(npz[k])
+                    else:
+                        out[k].append(_npz_strings(npz[k + ".data"], npz[k + ".ends"]))
+    if numpy:
+        return {k: numpy.concatenate(v) for k, v in out.items()}
+    return {k: sum(v, []) for k, v in out.items()}
+
+
+def _backfill_row(name, value):
+    import json
+    try:
+        return row(name, json.loads(value.decode()))
+    except ValueError:
+        return
+
+
+def backfill(src, folder, workers=None):
+    """rows of what is already in LevelDB (or fs), with `parallel_scan`"""
+    import parallel_scan
+
+    exporter = Exporter(folder)
+    source = parallel_scan.source_of(src)
+    for r, text in parallel_scan.scan(source, _backfill_row, workers):
+        exporter.add_row(r, text)
+    exporter.flush(force=True)
+
+
+def main(cmd=None, *args):
+    """
+    ./columns.py count export err [tail ...]   # most common values of the columns
+    ./columns.py backfill hosts.ldb export [workers]
+    """
+
+    if cmd == "count":
+        folder, *names = args
+        cols = load(folder, names)
+        for k in names:
+            print(k, collections.Counter(cols[k].tolist() if numpy else cols[k]).most_common(20))
+    elif cmd == "backfill":
+        src, folder, *workers = args
+        backfill(src, folder, workers and int(workers[0]))
+    else:
+        import doctest
+        doctest.testmod()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
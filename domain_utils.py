@@ -1,47 +1,187 @@
 #!/usr/bin/env python3
 
+import contextlib
+import hashlib
 import io
+import marshal
+import os
 import time
-import re
 
 
-def _init():
-    with open('public_suffix_list.dat') as f:
-        l = [i.strip() for i in filter(re.compile("^[a-z.]+\n$").fullmatch, f)]
+PSL_FILE = "public_suffix_list.dat"
+END_ICANN = "// ===END ICANN DOMAINS==="
+CACHE_FILE = PSL_FILE + ".trie"
+CACHE_VERSION = 2  # bump when `_init` builds something else
+END = "."  # key of the end of a rule in a node, never a label
 
-    s1 = set(filter(re.compile("^[a-z]+$").fullmatch, l))
-    s2 = set()
 
-    for i in l:
-        fs = i.split(".")
-        if len(fs) == 2 and len(fs[-1]) == 2 and fs[0] in s1:
-            s2.add(i)
+def _label(label):
+    """IDN rules are matched against the punycode (ACE) form of the hosts"""
+    if label.isascii():
+        return label
+    return "xn--" + label.encode("punycode").decode()
 
-    return s1 | s2
 
+def _init(fn=PSL_FILE, private=False):
+    """The rules as a trie of reversed labels, {label: node}; in a node, END
+    marks the end of a rule, "*" a wildcard child, "!<label>" an exception.
 
-suffixes = _init()
+    Only the ICANN section by default: with the private one, "x.blogspot.com"
+    would be its own tail, and the "blogs" suffixes of the hub no more match.
+    """
+
+    root = {}
+    with open(fn, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(END_ICANN) and not private:
+                break
+            rule = line.strip().split(" ", 1)[0]
+            if not rule or rule.startswith("//"):
+                continue
+
+            exception = rule.startswith("!")
+            labels = [_label(i) for i in rule.lstrip("!").lower().split(".")]
+            if exception:
+                labels[0] = "!" + labels[0]
+
+            node = root
+            for label in reversed(labels):
+                node = node.setdefault(label, {})
+            if not exception:
+                node[END] = True
+
+    return root
+
+
+def _load(fn=PSL_FILE, cache=CACHE_FILE):
+    """`_init` once per version of the PSL file, the trie is kept in `cache`
+    (marshal, ~6 times faster to load than parsing) with the file's hash
+    """
+
+    with open(fn, "rb") as f:
+        key = CACHE_VERSION, hashlib.sha1(f.read()).hexdigest()
+
+    with contextlib.suppress(OSError, ValueError, EOFError, TypeError):
+        with open(cache, "rb") as f:
+            cached_key, root = marshal.loads(f.read())  # load(f) is much slower
+        if cached_key == key:
+            return root
+
+    root = _init(fn)
+    with contextlib.suppress(OSError):  # e.g. a read-only checkout
+        tmp = "{}.{}".format(cache, os.getpid())
+        with open(tmp, "wb") as f:
+            marshal.dump((key, root), f)
+        os.replace(tmp, cache)
+    return root
+
+
+rules = _load()
+
+
+def _suffix(name):
+    """Where the longest public suffix of `name` starts, -1 if it has none,
+    None if a label of `name` is empty
+    """
+
+    node = rules
+    suffix = -1
+    end = len(name)
+    while True:
+        dot = name.rfind(".", 0, end)  # -1 if not found
+        label = name[dot + 1:end]
+        if not label:  # "a..b", ".a", "a." or ""
+            return None
+        if "!" + label in node:
+            suffix = end + 1
+            break
+        if "*" in node:
+            suffix = dot + 1
+        node = node.get(label)
+        if node is None:
+            break
+        if END in node:
+            suffix = dot + 1
+        if dot < 0:
+            break
+        end = dot
+    return suffix
+
+
+def _tail(name, suffix):
+    if suffix is not None and suffix > 0:
+        name = name[name.rfind(".", 0, suffix - 1) + 1:]
+        if not name.startswith("."):
+            return name
 
 
 def tail(name):
-    idx = name.rindex(".")  # raise if error
-    s1 = name[idx + 1:]
-    idx = name.rfind(".", 0, idx)  # -1 if not found
-    s2 = name[idx + 1:]
-    idx = name.rfind(".", 0, idx)
-    s3 = name[idx + 1:]
-    if s2 in suffixes:
-        return s3
-    elif s1 in suffixes:
-        return s2
+    """The registrable domain of `name`: its public suffix and one more label
+
+    None if `name` is a public suffix itself, or its TLD is unknown (no
+    implicit "*" rule, so made-up TLDs are not taken as hosts).
+    """
+
+    return _tail(name, _suffix(name))
+
+
+def _deep(node, depth, labels=()):
+    """the suffixes of `depth` labels after which some rule goes on"""
+    for label, child in node.items():
+        if label == END:
+            continue
+        suffix = (label,) + labels
+        if len(suffix) < depth:
+            yield from _deep(child, depth, suffix)
+        elif set(child) - {END}:
+            yield ".".join(suffix)
+
+
+deep = set(_deep(rules, 3))
+
+
+def tail_many(names):
+    """`tail` of each of `names`, as a list
+
+    The hosts found on a page share a few suffixes: the walk is done once
+    per last 3 labels, which hold the tail but when they are a public suffix
+    or one of the `deep` ones. Only ~10% faster than `tail` on each (~2us a
+    name): the walk is short already.
+    """
+
+    walked = dict.fromkeys(deep, True)  # last 3 labels: their tail, True for `tail`
+    out = []
+    for name in names:
+        labels = name.rsplit(".", 3)
+        if len(labels) < 4:
+            out.append(tail(name))
+            continue
+        key = name[len(labels[0]) + 1:]
+        if key not in walked:
+            suffix = _suffix(key)
+            walked[key] = True if suffix == 0 else _tail(key, suffix)
+        t = walked[key]
+        out.append(tail(name) if t is True else t)
+    return out
 
 
 def main():
-    suffixes
+    rules
     assert tail("g.cn") == "g.cn"
     assert tail("a.b.c.g.com.cn") == "g.com.cn"
     assert tail("www.baidu.com") == "baidu.com"
     assert tail("baidu.com") == "baidu.com"
+    assert tail("com.cn") is None
+    assert tail("a.b.invalidtld") is None
+    assert tail("foo..com") is None and tail("") is None and tail("a.com.") is None
+    assert tail("a.b.c.ck") == "b.c.ck"
+    assert tail("a.www.ck") == "www.ck"
+    assert tail("a.b.kawasaki.jp") == "a.b.kawasaki.jp"
+    assert tail("a.city.kawasaki.jp") == "city.kawasaki.jp"
+    assert tail("www.x.xn--55qx5d.cn") == "x.xn--55qx5d.cn"
+    names = ["a.b.c.g.com.cn", "x.com.cn", "www.baidu.com", "a.www.ck", "a.b.c.ck", "cn", "q",
+             "x.a.b.kawasaki.jp", "x.a.city.kawasaki.jp", "a.b.pvt.k12.ma.us", "a.b..com"]
+    assert tail_many(names) == [tail(i) for i in names]
     existed = set()
     while True:
         i = input()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Consistent hashing of host names onto hub shards, used by the hub and by
+the workers so that both agree on which shard owns a host.
+"""
+
+import bisect
+import collections
+import hashlib
+
+
+class HashRing():
+    """
+    >>> ring = HashRing(range(4))
+    >>> ring.get("q.org") == HashRing([0, 1, 2, 3]).get("q.org")
+    True
+    >>> moved = sum(ring.get(str(i)) != HashRing(range(5)).get(str(i)) for i in range(10000))
+    >>> 1000 < moved < 3000  # about 1/5 of the keys move to the new shard
+    True
+    """
+
+    VNODES = 160
+
+    def __init__(self, nodes, vnodes=VNODES):
+        points = sorted((self._hash("{}#{}".format(node, i)), node)
+                        for node in nodes for i in range(vnodes))
+        self._points = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(s):
+        return int.from_bytes(hashlib.md5(s.encode()).digest()[:8], "big")
+
+    def get(self, key):
+        idx = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._nodes[idx]
+
+
+class HubShards():
+    """Addresses of the hub shards, `ports` from GET /shards of any of them
+
+    >>> shards = HubShards("hub.lan:1033", [1033, 1034])
+    >>> sorted(shards.split([("q.org", b""), ("q.net", b"")]))
+    ['hub.lan:1033', 'hub.lan:1034']
+    >>> HubShards("hub.lan:1033").address("q.org")
+    'hub.lan:1033'
+    """
+
+    def __init__(self, hub_host, ports=None):
+        if ports:
+            hostname = hub_host.rpartition(":")[0] or hub_host
+            self.addresses = ["{}:{}".format(hostname, port) for port in ports]
+        else:  # a hub without /shards
+            self.addresses = [hub_host]
+        self.ring = HashRing(range(len(self.addresses)))
+
+    def address(self, name):
+        return self.addresses[self.ring.get(name)]
+
+    def split(self, records):
+        """[(name, record), ...] -> {address: [(name, record), ...]}"""
+        shards = collections.defaultdict(list)
+        for name, record in records:
+            shards[self.address(name)].append((name, record))
+        return shards
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import collections
+import concurrent.futures
 import contextlib
 import datetime
 import functools
@@ -13,6 +14,7 @@ import random
 import re
 import resource
 import signal
+import threading
 import time
 
 import leveldb
@@ -20,10 +22,15 @@ import redis
 import tornado.ioloop
 import tornado.options
 import tornado.gen
+import tornado.httpclient
+import tornado.process
 import tornado.web
 
 import tasks_publisher
+import codec
+import columns
 import domain_utils
+import hash_ring
 import sqliteset
 import cz88_ip
 import my_q
@@ -36,15 +43,162 @@ is_valid_host = re.compile(
 ).fullmatch
 
 
+class SuffixCache():
+    """In-process copy of the "blogs" and "ignored" suffix sets
+
+    Reloaded when "suffixes_version" changes (checked at most once per
+    `CHECK_INTERVAL`), when older than `TTL`, or on `invalidate`.
+    Whoever edits those sets should `INCR suffixes_version`, or
+    `curl -d "reload" localhost:1033/_cmd`.
+    """
+
+    CHECK_INTERVAL = 1
+    TTL = 300
+
+    def __init__(self, redis_cli):
+        self.redis_cli = redis_cli
+        self.version = None
+        self.checked = self.loaded = 0
+        self.blogs = self.ignored = frozenset()
+
+    def get(self):
+        now = time.time()
+        if now - self.checked > self.CHECK_INTERVAL:
+            self.checked = now
+            version = self.redis_cli.get("suffixes_version")
+            if version != self.version or now - self.loaded > self.TTL:
+                self._load(version, now)
+        return self.blogs, self.ignored
+
+    def _load(self, version, now):
+        p = self.redis_cli.pipeline()
+        p.smembers("blogs")
+        p.smembers("ignored")
+        blogs, ignored = p.execute()
+        self.blogs, self.ignored = frozenset(blogs), frozenset(ignored)
+        self.version = version
+        self.loaded = now
+
+    def invalidate(self):
+        self.redis_cli.incr("suffixes_version")
+        self.checked = self.loaded = 0
+
+
+class AsyncRedis():
+    """redis-py for the IOLoop: commands run on `threads` threads of their
+    own and return Futures, `run` does the same for any callable (like the
+    `execute` of a pipeline).
+
+    `hincrby`s, from the IOLoop or the ingest threads, are summed up in the
+    process and go to Redis in one pipeline when `flush_incrs` runs, every
+    `FLUSH_INTERVAL` seconds; `unflushed` tells what is not there yet.
+    `flush_incrs` runs on the IOLoop only.
+    """
+
+    THREADS = 4
+    FLUSH_INTERVAL = 1
+
+    def __init__(self, redis_cli, threads=THREADS):
+        self.redis_cli = redis_cli
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self._incrs = collections.Counter()
+        self._flushing = collections.Counter()
+        self._incrs_lock = threading.Lock()
+        self._in_flight = None  # the Future of the running `_flush`
+
+    def __getattr__(self, name):
+        return functools.partial(self.run, getattr(self.redis_cli, name))
+
+    def run(self, f, *args, **kwargs):
+        return self.executor.submit(f, *args, **kwargs)
+
+    def hincrby(self, key, field, n=1):
+        with self._incrs_lock:
+            self._incrs[key, field] += n
+
+    def unflushed(self, key, field):
+        with self._incrs_lock:
+            return self._incrs[key, field] + self._flushing[key, field]
+
+    @tornado.gen.coroutine
+    def flush_incrs(self, wait=False):
+        """skipped while one is running, unless `wait` (to stop): then after it"""
+        while self._in_flight is not None:
+            if not wait:
+                return
+            yield self._in_flight
+        self._in_flight = self._flush()
+        try:
+            yield self._in_flight
+        finally:
+            self._in_flight = None
+
+    @tornado.gen.coroutine
+    def _flush(self):
+        with self._incrs_lock:
+            if not self._incrs:
+                return
+            self._flushing, self._incrs = self._incrs, collections.Counter()
+
+        p = self.redis_cli.pipeline(transaction=False)
+        for (key, field), n in self._flushing.items():
+            p.hincrby(key, field, n)
+        try:
+            yield self.run(p.execute)
+        except Exception as e:
+            logging.exception(e)
+            with self._incrs_lock:  # try again next time
+                self._incrs.update(self._flushing)
+        with self._incrs_lock:
+            self._flushing = collections.Counter()
+
+
 class BaseHandler(tornado.web.RequestHandler):
-    db = leveldb.LevelDB("hosts.ldb")
+    """With SHARDS=N, `main` forks N hubs on ports PORT..PORT+N-1, sharing
+    Redis. Results of a host are kept by the shard `ring` maps its name to,
+    in its own LevelDB; the others redirect or forward to it. Anything else
+    is served by any shard, except "/mail" and "/worker(s)" which keep their
+    state in the process: use the first one for those.
+    """
+
+    db = None  # see `open_shard`
+    shard = 0
+    shard_ports = []
+    ring = None
     redis_cli = redis.StrictRedis(unix_socket_path="etc/.redis.sock",
                                   decode_responses=True)
     lua_scripts = {
         "add_hosts": redis_cli.script_load("""
+            local cmd = ARGV[1] or "rpush"
             local n = 0
             for _, host in pairs(KEYS) do
                 if redis.call("sadd", "hosts", host) == 1 then
+                    redis.call(cmd, "queue", host)
+                    n = n + 1
+                end
+            end
+            return n
+        """),
+        "pop_hosts": redis_cli.script_load("""
+            local hosts = redis.call("lrange", "queue", 0, tonumber(ARGV[1]) - 1)
+            if #hosts > 0 then
+                redis.call("ltrim", "queue", #hosts, -1)
+                for _, host in pairs(hosts) do
+                    redis.call("zadd", "leases", ARGV[2], host)
+                end
+            end
+            return hosts
+        """),
+        "requeue_expired": redis_cli.script_load("""
+            local hosts = redis.call("zrangebyscore", "leases", "-inf", ARGV[1],
+                                     "limit", 0, tonumber(ARGV[2]))
+            local n = 0
+            for _, host in pairs(hosts) do
+                redis.call("zrem", "leases", host)
+                if redis.call("hincrby", "lease_retries", host, 1) > tonumber(ARGV[3]) then
+                    redis.call("hdel", "lease_retries", host)
+                    redis.call("hincrby", "cnt", "lease_dropped", 1)
+                else
                     redis.call("rpush", "queue", host)
                     n = n + 1
                 end
@@ -53,7 +207,37 @@ class BaseHandler(tornado.web.RequestHandler):
         """),
     }
 
+    aredis = AsyncRedis(redis_cli)
     known_tail_names = set()
+    suffix_cache = SuffixCache(redis_cli)
+
+    @classmethod
+    def open_shard(cls, shard, ports):
+        """hosts.ldb for the first shard, hosts.ldb.<shard> for the others
+
+        Entries already in hosts.ldb stay there when SHARDS changes, even
+        if they belong to another shard now.
+        """
+
+        cls.shard, cls.shard_ports = shard, ports
+        cls.ring = hash_ring.HashRing(range(len(ports)))
+        cls.db = leveldb.LevelDB("hosts.ldb.{}".format(shard) if shard else "hosts.ldb")
+
+    def owner(self, name):
+        """port of the shard keeping `name`, None if it is this one"""
+        if len(self.shard_ports) > 1:
+            shard = self.ring.get(name)
+            if shard != self.shard:
+                return self.shard_ports[shard]
+
+    def redirect_to_owner(self, name):
+        port = self.owner(name)
+        if port is None:
+            return False
+        host = self.request.host.partition(":")[0]
+        self.redirect("{}://{}:{}{}".format(self.request.protocol, host, port,
+                                            self.request.uri), status=307)
+        return True
 
     def set_default_headers(self):
         self.set_header("Content-Type", "text/plain; charset=UTF-8")
@@ -70,34 +254,94 @@ class MainHandler(BaseHandler):
 
 
 class CommandHandler(BaseHandler):
+    @tornado.gen.coroutine
     def post(self):
         cmd = self.request.body.decode()
         if cmd == "renew":
-            self.redis_cli.delete("suffixes_warned")
+            yield self.aredis.delete("suffixes_warned")
+        elif cmd == "reload":
+            yield self.aredis.run(self.suffix_cache.invalidate)
         else:
             raise tornado.web.HTTPError(404)
 
 
+class ShardsHandler(BaseHandler):
+    def get(self):
+        self.write_json({"shard": self.shard, "ports": self.shard_ports})
+
+
 class HostHandler(BaseHandler):
+    """Every host handed out is leased in the "leases" sorted set (score is
+    the deadline) until its result arrives at `HostInfoHandler.post`;
+    `requeue_expired` puts it back into "queue" otherwise.
+    """
+
     workers = collections.defaultdict(dict)
+    MAX_HOSTS_PER_GET = 1000
+    LEASE_TIMEOUT = int(os.environ.get("LEASE_TIMEOUT", 1800))
+    LEASE_MAX_RETRIES = 3
+    REQUEUE_BATCH = 1000
 
+    @tornado.gen.coroutine
     def get(self):
+        """GET /host -> {"host": ...}, GET /host?n=K -> {"hosts": [...]}
+        """
+
         resp = {}
-        host = self.redis_cli.lpop("queue")
-        if host is None:
+        try:
+            n = int(self.get_argument("n", 0))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        hosts = yield self.lease(min(max(n, 1), self.MAX_HOSTS_PER_GET))
+        if not hosts:
             raise tornado.web.HTTPError(404)
-        resp["host"] = host
+        if n > 0:
+            resp["hosts"] = hosts
+        else:
+            resp["host"] = hosts[0]
+        self.set_header("Accept-Post", "{}, {}".format(codec.RECORDS_TYPE, codec.RECORD_TYPE))
         self.write_json(resp)
 
+    def lease(self, n):
+        deadline = time.time() + self.LEASE_TIMEOUT
+        return self.aredis.evalsha(self.lua_scripts["pop_hosts"], 0, n, deadline)
+
+    @staticmethod
+    def ack(redis_cli, *names):
+        redis_cli.zrem("leases", *names)
+        redis_cli.hdel("lease_retries", *names)
+
+    @classmethod
+    @tornado.gen.coroutine
+    def requeue_expired(cls):
+        n = yield cls.aredis.evalsha(cls.lua_scripts["requeue_expired"], 0, time.time(),
+                                     cls.REQUEUE_BATCH, cls.LEASE_MAX_RETRIES)
+        if n:
+            logging.info("requeue %s expired leases", n)
+
+    @tornado.gen.coroutine
     def post(self):
+        """POST /host: new hosts, first in the queue
+
+        POST /host?giveback=1: leased hosts a worker will not crawl, their
+        leases released and the hosts put last in the queue
+        """
+
         hosts = self.request.body.decode().split()
-        if hosts:
-            self.redis_cli.lpush("queue", *hosts)
+        if not hosts:
+            return
+        if self.get_argument("giveback", None):
+            p = self.redis_cli.pipeline(transaction=False)
+            self.ack(p, *hosts)
+            p.rpush("queue", *hosts)
+            yield self.aredis.run(p.execute)
+        else:
+            yield self.aredis.lpush("queue", *hosts)
 
 
-from simple_scan import page1 as _page1, domain_pattern as _domain_pattern
+from simple_scan import page1 as _page1, domain_matcher as _domain_matcher
 def _simple_check(host_name, info):
-    if _domain_pattern.search(host_name):
+    if _domain_matcher.search(host_name):
         return True
     if sum(_page1(info)):
         return True
@@ -105,88 +349,249 @@ def _simple_check(host_name, info):
 
 
 class HostInfoHandler(BaseHandler):
+    """`_ingest` runs in `executor`, off the IOLoop. At most `MAX_PENDING`
+    bodies wait or run there, beyond that POSTs get 503 and "Retry-After".
+    """
+
     my_redis_queues = my_q.MyQueues()
+    INGEST_THREADS = int(os.environ.get("INGEST_THREADS", 2))
+    MAX_PENDING = 64
+    RETRY_AFTER = 5
+    executor = concurrent.futures.ThreadPoolExecutor(INGEST_THREADS)
+    pending = 0
+    stopping = False  # see `main`
+    _warning_lock = threading.Lock()
+    exporter = None  # a `columns.Exporter`, see `main`
 
     def get(self, name):
+        if self.redirect_to_owner(name):
+            return
         try:
-            self.write(bytes(self.db.Get(name.encode())))
+            record = bytes(self.db.Get(name.encode()))
         except KeyError:
             raise tornado.web.HTTPError(404)
+        self.write(codec.decode(record))  # KeyError: a dictionary missing here
 
+    @tornado.gen.coroutine
     def post(self, name):
-        ts = time.strftime("%Y%m%d-%H%M")
+        if not self.redirect_to_owner(name):
+            bad = yield self.ingest([(name, self.request.body)])
+            if bad:
+                raise tornado.web.HTTPError(400)
 
-        blog_suffixes = self.redis_cli.smembers("blogs")
-        ignored_suffixes = self.redis_cli.smembers("ignored")
-        hincrby = self.redis_cli.hincrby
-        hincrby("cnt", "done")
-        hincrby("cnt_done", ts)
-        hincrby("cnt_done", ts[:-2])
-        content = self.request.body
-        info = json.loads(content.decode())
-        self._notice(name, info)
-
-        other_hosts_found = info.get("other_hosts_found")
-        if other_hosts_found:
-            size_of_found = len(other_hosts_found)
-            tail_counter = collections.Counter()
-            warnings = []
-
-            other_hosts = []
-            for i in other_hosts_found:
-                tail = domain_utils.tail(i)
-                if not tail or tail in ignored_suffixes:
-                    continue
-                if tail in blog_suffixes:
-                    self.my_redis_queues["blog:" + tail].append(i[:-len(tail)])
-                    continue
-                other_hosts.append(i)
-                tail_counter[tail] += 1
-                if tail not in self.known_tail_names:
-                    warnings.append(i)
-
-            warned_tail_flag = False
-            for k, v in tail_counter.most_common(2):
-                if v > 5 and v / size_of_found > 0.4:  # temporary 40%
-                    self.redis_cli.hincrby("warned_tail", k, v)
-                    warned_tail_flag = True
-
-            if warned_tail_flag or len(warnings) / size_of_found > 0.3:  # temporary 30%
-                with open("log/warning_hosts.txt", "a") as f:
-                    print(name, *warnings, file=f)
-            else:
-                n_found = self.redis_cli.evalsha(
-                    self.lua_scripts["add_hosts"], len(other_hosts), *other_hosts)
-                if n_found:
-                    hincrby("cnt", "found")
-                    hincrby("cnt_found", ts, n_found)
-                    hincrby("cnt_found", ts[:-2], n_found)
+    def delete(self, name):
+        if not self.redirect_to_owner(name):
+            self.db.Delete(name.encode())
 
-        redirect = info.get("redirect")
-        if redirect and is_valid_host(redirect):
-            if self.redis_cli.sadd("hosts", redirect):
-                self.redis_cli.lpush("queue", redirect)
+    @tornado.gen.coroutine
+    def ingest(self, results):
+        if HostInfoHandler.pending >= self.MAX_PENDING or self.stopping:
+            self.set_status(503)
+            self.set_header("Retry-After", self.RETRY_AFTER)
+            self.finish()
+            return
+        HostInfoHandler.pending += 1
+        try:
+            bad = yield self.executor.submit(self._ingest, results)
+        finally:
+            HostInfoHandler.pending -= 1
+        return bad
 
-        self.db.Put(name.encode(), content)
+    def _ingest(self, results):
+        """results: [(name, content), ...], returns the names of the bad ones
 
-    def delete(self, name):
-        self.db.Delete(name.encode())
+        One LevelDB `WriteBatch` and one Redis pipeline for all of them.
+        `content` is plain JSON or a `codec` record, stored as a record.
+        A bad one (not JSON, a zdict missing here) is logged and skipped,
+        not acked: its host is crawled again when the lease expires.
+        """
 
-    def _notice(self, name, info):
+        ts = time.strftime("%Y%m%d-%H%M")
+
+        blog_suffixes, ignored_suffixes = self.suffix_cache.get()
+
+        p = self.redis_cli.pipeline(transaction=False)
+        batch = leveldb.WriteBatch()
+        blogs = collections.defaultdict(list)
+        warning_lines = []
+        found_at = []  # replies of "add_hosts" in `p`, numbers of new hosts
+        names = []
+        bad = []
+
+        for name, content in results:
+            try:
+                data = codec.decode(content)
+                info = json.loads(data.decode())
+                if not isinstance(info, dict):
+                    raise ValueError("not a JSON object")
+            except Exception as e:
+                logging.warning("bad result of %s: %r", name, e)
+                bad.append(name)
+                continue
+            if not content.startswith(codec.MAGIC):  # from an old worker
+                content = codec.encode(data)
+            names.append(name)
+            log = self._notice(name, info, p)
+            if self.exporter:
+                self.exporter.add(name, info, bad=log["bad"])
+
+            other_hosts_found = info.get("other_hosts_found")
+            if other_hosts_found:
+                size_of_found = len(other_hosts_found)
+                tail_counter = collections.Counter()
+                warnings = []
+
+                other_hosts = []
+                tails = domain_utils.tail_many(other_hosts_found)
+                for i, tail in zip(other_hosts_found, tails):
+                    if not tail or tail in ignored_suffixes:
+                        continue
+                    if tail in blog_suffixes:
+                        blogs["blog:" + tail].append(i[:-len(tail)])
+                        continue
+                    other_hosts.append(i)
+                    tail_counter[tail] += 1
+                    if tail not in self.known_tail_names:
+                        warnings.append(i)
+
+                warned_tail_flag = False
+                for k, v in tail_counter.most_common(2):
+                    if v > 5 and v / size_of_found > 0.4:  # temporary 40%
+                        p.hincrby("warned_tail", k, v)
+                        warned_tail_flag = True
+
+                if warned_tail_flag or len(warnings) / size_of_found > 0.3:  # temporary 30%
+                    warning_lines.append((name, *warnings))
+                elif other_hosts:
+                    found_at.append(len(p))
+                    p.evalsha(self.lua_scripts["add_hosts"], len(other_hosts),
+                              *other_hosts, "rpush")
+
+            redirect = info.get("redirect")
+            if redirect and is_valid_host(redirect):
+                p.evalsha(self.lua_scripts["add_hosts"], 1, redirect, "lpush")
+
+            batch.Put(name.encode(), content)
+
+        if warning_lines:
+            with self._warning_lock, open("log/warning_hosts.txt", "a") as f:
+                for line in warning_lines:
+                    print(*line, file=f)
+
+        if not names:
+            return bad
+        self.db.Write(batch)
+
+        self.aredis.hincrby("cnt", "done", len(names))
+        self.aredis.hincrby("cnt_done", ts, len(names))
+        self.aredis.hincrby("cnt_done", ts[:-2], len(names))
+        HostHandler.ack(p, *names)
+        replies = p.execute()
+
+        found = [replies[i] for i in found_at if replies[i]]
+        if found:
+            self.aredis.hincrby("cnt", "found", len(found))
+            self.aredis.hincrby("cnt_found", ts, sum(found))
+            self.aredis.hincrby("cnt_found", ts[:-2], sum(found))
+
+        for k, v in blogs.items():
+            self.my_redis_queues[k].append(*v)
+        return bad
+
+    def _notice(self, name, info, redis_cli):
         log = {
             "host": name,
             "bad": _simple_check(name, info),
         }
 
         if log["bad"]:
-            self.redis_cli.hincrby("cnt", "bad", 1)
+            self.aredis.hincrby("cnt", "bad", 1)
 
         try:
             log["location"] = cz88_ip.find(info["ip"])
         except Exception:
             "logging.exception(info)"
 
-        TailHandler.pub(log)
+        TailHandler.pub(log, redis_cli)
+        return log
+
+
+class HostInfoBatchHandler(HostInfoHandler):
+    """POST /host-info with many results in one body, one per line::
+
+        <name>\\t<compact json>\\n
+
+    or, with "Content-Type: application/x-robot2-records", `codec.frame`d
+    records.
+
+    Results of hosts kept by other shards are forwarded to them, workers
+    using `hash_ring.HubShards` send them to the right one in the first place.
+    The names of those a shard down or behind did not take are answered as
+    {"retry": [name, ...]}, for the worker to send again.
+    """
+
+    SUPPORTED_METHODS = ("POST",)
+
+    @tornado.gen.coroutine
+    def post(self):
+        body = self.request.body
+        content_type = self.request.headers.get("Content-Type", "")
+        results = []
+        if content_type.partition(";")[0].strip() == codec.RECORDS_TYPE:
+            try:
+                for name, content in codec.unframe(body):
+                    results.append((name, content))
+            except ValueError as e:  # the records before it are still good
+                logging.warning("bad body: %r", e)
+        else:
+            for line in body.splitlines():
+                if not line:
+                    continue
+                name, _, content = line.partition(b"\t")
+                try:
+                    results.append((name.decode(), content))
+                except ValueError as e:
+                    logging.warning("bad line: %r", e)
+
+        others = collections.defaultdict(list)
+        mine = []
+        for name, content in results:
+            port = self.owner(name)
+            if port is None:
+                mine.append((name, content))
+            else:
+                others[port].append((name, content))
+
+        if mine:
+            yield self.ingest(mine)
+            if self._finished:  # 503, the worker sends them all again
+                return
+        if others:
+            ports = list(others)
+            failed = yield [self.forward(port, others[port]) for port in ports]
+            retry = [name for port, f in zip(ports, failed) if f for name, _ in others[port]]
+            if retry:
+                self.write_json({"retry": retry})
+
+    @staticmethod
+    @tornado.gen.coroutine
+    def forward(port, records):
+        """True if the shard is down or behind, and the worker should send
+        them again (see `codec.resend`); other errors are only logged
+        """
+
+        body, headers = codec.batch(records)
+        try:
+            yield tornado.httpclient.AsyncHTTPClient().fetch(
+                "http://127.0.0.1:{}/host-info".format(port),
+                method="POST", body=body, headers=headers)
+        except tornado.httpclient.HTTPError as e:
+            logging.warning("forward to %s: %s", port, e)
+            return e.code in (503, 599)
+        except OSError as e:
+            logging.warning("forward to %s: %r", port, e)
+            return True
+        return False
 
 
 class MailHandler(BaseHandler):
@@ -245,16 +650,31 @@ class WorkerHandler(MailHandler):
 
 
 class StatusHandler(BaseHandler):
+    @tornado.gen.coroutine
     def get(self, name):
-        return getattr(self, "get_status_" + name)()
+        yield getattr(self, "get_status_" + name)()
 
+    @tornado.gen.coroutine
     def get_status_cnt(self):
-        cnt = {k: int(v) for k, v in self.redis_cli.hgetall("cnt").items()}
+        cnt = yield self.aredis.hgetall("cnt")
+        cnt = collections.Counter({k: int(v) for k, v in cnt.items()})
+        for k in ["done", "bad", "found"]:
+            cnt[k] += self.aredis.unflushed("cnt", k)
         analysed = cnt["done"] - random.randint(10000, 20000)
         if cnt.get("analysed", 0) < analysed:
-            self.redis_cli.hset("cnt", "analysed", analysed)
+            yield self.aredis.hset("cnt", "analysed", analysed)
         self.write_json(cnt)
 
+    @tornado.gen.coroutine
+    def get_status_leases(self):
+        p = self.redis_cli.pipeline()
+        p.zcard("leases")
+        p.zcount("leases", "-inf", time.time())
+        p.hlen("lease_retries")
+        counts = yield self.aredis.run(p.execute)
+        self.write_json(dict(zip(["leased", "expired", "retried"], counts)))
+
+    @tornado.gen.coroutine
     def get_status_recent(self):
         recent = {}
         dt = datetime.datetime.now()
@@ -263,12 +683,14 @@ class StatusHandler(BaseHandler):
         l = [(dt - datetime.timedelta(minutes=i)).strftime("%Y%m%d-%H%M") for i in reversed(range(60))]
         for i in l:
             p.hincrby('cnt_done', i, 0)
-        recent["minutes"] = p.execute()
+        done = yield self.aredis.run(p.execute)
+        recent["minutes"] = [n + self.aredis.unflushed("cnt_done", i) for n, i in zip(done, l)]
 
         l = [(dt - datetime.timedelta(hours=i)).strftime("%Y%m%d-%H") for i in reversed(range(48))]
         for i in l:
             p.hincrby('cnt_done', i, 0)
-        recent["hours"] = p.execute()
+        done = yield self.aredis.run(p.execute)
+        recent["hours"] = [n + self.aredis.unflushed("cnt_done", i) for n, i in zip(done, l)]
 
         self.write_json(recent)
 
@@ -276,9 +698,31 @@ class StatusHandler(BaseHandler):
 class TailHandler(BaseHandler):
     _todos = collections.defaultdict(list)
     _callbacks = []
+    CHANNEL = "tail"
+    io_loop = None  # set in `main`, the ingest threads have no IOLoop of their own
+
+    @classmethod
+    def pub(cls, log, redis_cli=None):
+        """sharded, logs go through Redis so that every shard sees all of them
+
+        May be called from the ingest threads.
+        """
+        if len(cls.shard_ports) > 1:
+            (redis_cli or cls.redis_cli).publish(cls.CHANNEL, json.dumps(log))
+        else:
+            cls.io_loop.add_callback(cls.pub_local, log)
+
+    @classmethod
+    def subscribe(cls):
+        def _listen():
+            pubsub = cls.redis_cli.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(cls.CHANNEL)
+            for message in pubsub.listen():
+                cls.io_loop.add_callback(cls.pub_local, json.loads(message["data"]))
+        threading.Thread(target=_listen, daemon=True).start()
 
     @classmethod
-    def pub(cls, log):
+    def pub_local(cls, log):
         discards = []
         for token, todo in cls._todos.items():
             todo.append(log)
@@ -306,12 +750,14 @@ class TailHandler(BaseHandler):
 
 handlers = [
     (r"/host", HostHandler),
+    (r"/host-info", HostInfoBatchHandler),
     (r"/host-info/(.+)", HostInfoHandler),
     (r"/tail/(.+)", TailHandler),
     (r"/status/(.+)", StatusHandler),
     (r"/mail/(.+)", MailHandler),
     (r"/workers", WorkerHandler),
     (r"/worker/(.+)", WorkerHandler),
+    (r"/shards", ShardsHandler),
     (r"/_cmd", CommandHandler),
     (r"/(.+)", tornado.web.StaticFileHandler, {"path": "html"}),
     (r"/", MainHandler),
@@ -331,21 +777,54 @@ def main():
         BaseHandler.known_tail_names.update(f.read().split())
 
     p = int(os.environ.get("PORT", 1033))
-    tornado.web.Application(
+    n_shards = int(os.environ.get("SHARDS", 1))
+    shard = tornado.process.fork_processes(n_shards) if n_shards > 1 else 0
+    BaseHandler.open_shard(shard, [p + i for i in range(n_shards)])
+
+    server = tornado.web.Application(
         handlers,
-    ).listen(p, xheaders=True)
+    ).listen(p + shard, xheaders=True)
 
-    with contextlib.suppress(ImportError):
-        import tornadospy
-        tornadospy.listen(p + 1)
+    if shard == 0:
+        with contextlib.suppress(ImportError):
+            import tornadospy
+            tornadospy.listen(p + n_shards)
 
-    io_loop = tornado.ioloop.IOLoop.instance()
+    io_loop = TailHandler.io_loop = tornado.ioloop.IOLoop.instance()
 
-    def _term(*_):
+    if n_shards > 1:
+        TailHandler.subscribe()
+
+    if shard == 0:
+        tornado.ioloop.PeriodicCallback(HostHandler.requeue_expired, 10 * 1000).start()
+
+    aredis = BaseHandler.aredis
+    tornado.ioloop.PeriodicCallback(aredis.flush_incrs, aredis.FLUSH_INTERVAL * 1000).start()
+
+    export_dir = os.environ.get("EXPORT_DIR", "export")
+    if export_dir and columns.FORMAT:
+        exporter = HostInfoHandler.exporter = columns.Exporter(export_dir)
+        tornado.ioloop.PeriodicCallback(
+            functools.partial(HostInfoHandler.executor.submit, exporter.flush),
+            exporter.PART_INTERVAL * 1000).start()
+
+    @tornado.gen.coroutine
+    def _stop():
+        # no more ingests, wait for the running ones and the counters they add
+        HostInfoHandler.stopping = True
+        server.stop()
+        while HostInfoHandler.pending:
+            yield tornado.gen.sleep(0.1)
+        yield aredis.flush_incrs(wait=True)
+        if HostInfoHandler.exporter:
+            yield HostInfoHandler.executor.submit(HostInfoHandler.exporter.flush, True)
         #io_loop.close(True)
         io_loop.stop()
         logging.info("stop")
 
+    def _term(*_):
+        io_loop.add_callback_from_signal(_stop)
+
     signal.signal(signal.SIGTERM, _term)
 
     logging.info("start")
@@ -356,5 +835,6 @@ if __name__ == "__main__":
     main()
     """
     curl -d "renew" 'localhost:1033/_cmd'
+    curl -d "reload" 'localhost:1033/_cmd'
     curl -d "rebuild" 'localhost:1033/_cmd'
     """
@@ -15,6 +15,8 @@ import tornado.web
 
 import leveldb
 
+import codec
+
 gc.disable()
 
 
@@ -39,13 +41,13 @@ class MainHandler(BaseHandler):
 class DataHandler(BaseHandler):
     def get(self, name):
         try:
-            self.write(bytes(self.db.Get(name.encode())))
+            self.write(codec.decode(bytes(self.db.Get(name.encode()))))
         except KeyError:
             raise tornado.web.HTTPError(404)
 
     def post(self, name):
         content = self.request.body
-        self.db.Put(name.encode(), content)
+        self.db.Put(name.encode(), codec.encode(content))
 
     def delete(self, name):
         self.db.Delete(name.encode())
@@ -73,7 +75,7 @@ class IterHandler(BaseHandler):
             k, v = next(self._iter)
         except StopIteration:
             raise tornado.web.HTTPError(404)
-        self.write(b'' + k + b'\n' + v)
+        self.write(b'' + k + b'\n' + codec.decode(bytes(v)))
 
     def post(self):
         def argv(k):
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Scan all the crawl results with one process per core.
+
+A source is split into many key ranges; each worker process reads its
+ranges with its own iterator and applies `func(name, value)` to every
+result, `value` being the decoded JSON bytes. Whatever `func` returns,
+except None, is streamed back, in key order or as soon as it is ready.
+
+LevelDB allows one process per database, so every worker opens its own
+clone of it: the table files (immutable) are hard linked, the few others
+copied. Scan a stopped database or a copy; the one of a running hub may
+compact between the two steps, then the clone does not open.
+"""
+
+import functools
+import gzip
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+
+import codec
+
+
+RANGES_PER_WORKER = 16  # small ranges even out the uneven key space
+HOST_CHARS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+_dbs = {}  # path: the clone opened by this worker
+
+
+def clone_leveldb(src, dst):
+    os.mkdir(dst)
+    fns = sorted(os.listdir(src), key=lambda fn: not fn.endswith((".ldb", ".sst")))
+    for fn in fns:  # tables first, then the manifest and the logs
+        if fn == "LOCK":
+            continue
+        if fn.endswith((".ldb", ".sst")):
+            os.link(os.path.join(src, fn), os.path.join(dst, fn))
+        else:
+            shutil.copy(os.path.join(src, fn), os.path.join(dst, fn))
+
+
+class LevelDBSource():
+    """hosts.ldb, or all the shards: LevelDBSource("hosts.ldb", "hosts.ldb.1")"""
+
+    def __init__(self, *paths):
+        self.paths = [os.path.abspath(i) for i in paths]
+        self._tmp = None
+
+    def ranges(self, n):
+        """[lo, hi) of host names, cut at evenly spaced two-char prefixes"""
+        prefixes = [a + b for a in HOST_CHARS for b in HOST_CHARS]
+        bounds = [None] + [prefixes[len(prefixes) * i // n].encode()
+                           for i in range(1, n)] + [None]
+        return [(path, lo, hi) for path in self.paths
+                for lo, hi in zip(bounds, bounds[1:])]
+
+    def __enter__(self):
+        # hard links need the same file system
+        self._tmp = tempfile.mkdtemp(prefix=".scan-", dir=os.path.dirname(self.paths[0]))
+        return self
+
+    def __exit__(self, *_):
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def read(self, rng):
+        import leveldb
+
+        path, lo, hi = rng
+        db = _dbs.get(path)
+        if db is None:
+            clone = os.path.join(self._tmp, "{}.{}".format(os.getpid(), len(_dbs)))
+            clone_leveldb(path, clone)
+            db = _dbs[path] = leveldb.LevelDB(clone)
+        for k, v in db.RangeIter(key_from=lo, key_to=hi, fill_cache=False):
+            if hi is not None and k >= hi:  # key_to is inclusive
+                break
+            yield bytes(k).decode(), codec.decode(bytes(v))
+
+
+class FsSource():
+    """the fs/XX/XX/<name> tree of gzipped JSON files"""
+
+    def __init__(self, root="fs"):
+        self.root = root
+
+    def ranges(self, n):
+        dirs = sorted(os.listdir(self.root))
+        return [dirs[i * len(dirs) // n:(i + 1) * len(dirs) // n] for i in range(n)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+    def read(self, rng):
+        for d1 in rng:
+            for d2 in sorted(os.listdir(os.path.join(self.root, d1))):
+                p = os.path.join(self.root, d1, d2)
+                for fn in sorted(os.listdir(p)):
+                    try:
+                        with gzip.open(os.path.join(p, fn)) as f:
+                            yield fn, f.read()
+                    except Exception as e:
+                        print(e, type(e), p, fn, file=sys.stderr)
+
+
+def _scan_range(source, func, rng):
+    results = []
+    for name, value in source.read(rng):
+        r = func(name, value)
+        if r is not None:
+            results.append(r)
+    return results
+
+
+def scan(source, func, workers=None, ordered=False):
+    """Yield `func(name, value)` of every result of `source`, but None
+
+    `func` must be picklable (defined at the top level of a module).
+    """
+
+    workers = workers or os.cpu_count()
+    with source, multiprocessing.Pool(workers) as pool:
+        f = functools.partial(_scan_range, source, func)
+        ranges = source.ranges(workers * RANGES_PER_WORKER)
+        imap = pool.imap if ordered else pool.imap_unordered
+        for results in imap(f, ranges):
+            yield from results
+
+
+def source_of(path):
+    """"fs" or a LevelDB folder, or a comma separated list of them"""
+    if path == "fs" or path.rstrip("/").endswith("/fs"):
+        return FsSource(path)
+    return LevelDBSource(*path.split(","))
+
+
+def _count(name, value):
+    return len(value)
+
+
+def main(path="hosts.ldb", workers=None):
+    """./parallel_scan.py hosts.ldb[,hosts.ldb.1,...]|fs [workers]   # number and size of results"""
+    n = size = 0
+    for i in scan(source_of(path), _count, workers and int(workers)):
+        n += 1
+        size += i
+    print(n, size)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+resolver.py
+
+aiohttp 的 DNS resolver, 加了进程内的缓存:
+
+- 解析成功的结果缓存 `ttl` 秒, 失败的缓存 `negative_ttl` 秒
+- 同一个名字同时只会有一个查询, 其他的等它的结果
+- 真正的查询交给 `upstream`, 默认是 aiohttp 的 DefaultResolver
+  (装了 aiodns 可以换成 aiohttp.AsyncResolver)
+
+`robot2_async.Engine` 先用它拿到 info["ip"], 之后连接时再解析同一个名字
+直接命中缓存, 所以一个 HOST 只查一次.
+"""
+
+import asyncio
+import socket
+import sys
+import time
+
+import aiohttp
+import aiohttp.abc
+
+
+class CachingResolver(aiohttp.abc.AbstractResolver):
+    TTL = 600
+    NEGATIVE_TTL = 120
+    MAX_SIZE = 100000
+
+    def __init__(self, upstream=None, ttl=TTL, negative_ttl=NEGATIVE_TTL):
+        self.upstream = upstream or aiohttp.DefaultResolver()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = {}  # (host, family): (expires, hosts or exception)
+        self._pending = {}
+        self.hits = self.misses = 0
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        key = host, family
+        cached = self._cache.get(key)
+        if cached and cached[0] > time.monotonic():
+            self.hits += 1
+            result = cached[1]
+        else:
+            self.misses += 1
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = asyncio.ensure_future(self._lookup(key))
+                future.add_done_callback(lambda _: self._pending.pop(key, None))
+            result = await asyncio.shield(future)
+
+        if isinstance(result, Exception):
+            raise result
+        return [dict(i, port=port) for i in result]
+
+    async def _lookup(self, key):
+        host, family = key
+        try:
+            result = await self.upstream.resolve(host, 0, family)
+            expires = time.monotonic() + self.ttl
+        except OSError as e:
+            result = e
+            expires = time.monotonic() + self.negative_ttl
+
+        if len(self._cache) >= self.MAX_SIZE:
+            self._cache.clear()
+        self._cache[key] = expires, result
+        return result
+
+    async def close(self):
+        await self.upstream.close()
+
+
+class StubResolver(aiohttp.abc.AbstractResolver):
+    """不联网的 resolver, 每次查询花 `delay` 秒, 名字里有 "nx" 的查不到
+    """
+
+    def __init__(self, delay=0.02):
+        self.delay = delay
+        self.queries = 0
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        self.queries += 1
+        await asyncio.sleep(self.delay)
+        if "nx" in host:
+            raise OSError("Domain name not found", host)
+        ip = "10.0.{}.{}".format(*divmod(hash(host) % 65536, 256))
+        return [{"hostname": host, "host": ip, "port": port, "family": family,
+                 "proto": 0, "flags": socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
+
+
+def main(n=10000, n_names=1000):
+    """和不带缓存的比一比, 每个 HOST 像 `Engine` 那样解析两次
+
+    ./resolver.py [n] [n_names]
+    """
+
+    n, n_names = int(n), int(n_names)
+    names = ["www.{}.{}".format(i % n_names, "nx" if i % 10 == 0 else "com")
+             for i in range(n)]
+
+    async def crawl(resolver):
+        async def one(name):
+            for _ in range(2):  # info["ip"], then the connection
+                try:
+                    await resolver.resolve(name)
+                except OSError:
+                    return
+        await asyncio.gather(*map(one, names))
+
+    loop = asyncio.get_event_loop()
+    stub, stub_behind_cache = StubResolver(), StubResolver()
+    for label, queries, resolver in [
+            ("stub", stub, stub),
+            ("cached", stub_behind_cache, CachingResolver(stub_behind_cache))]:
+        t = time.time()
+        loop.run_until_complete(crawl(resolver))
+        print(label, "queries:", queries.queries,
+              "seconds: {:.3f}".format(time.time() - t))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -5,7 +5,9 @@ robot2.py
 """
 
 
+import codecs
 import datetime
+import html.parser
 import json
 import functools
 import logging
@@ -25,23 +27,20 @@ except ImportError:
             return lambda *args, **kwargs: None
     resource = _R()
 
-try:
-    import lxml
-    HTML_PARSER = "html5lib"
-    HTML_PARSER = "lxml"
-except ImportError:
-    HTML_PARSER = "html.parser"
-
-import bs4
 import click
 import requests
 
+import codec
+
 # https://urllib3.readthedocs.io/en/latest/advanced-usage.html#ssl-warnings
 requests.packages.urllib3.disable_warnings()
 
 
 # not now IMAGES_COUNT = int(os.environ.get("IMAGES_COUNT", 50))
 TOO_LONG = 1 * 1024 * 1024
+TEXT_LIMIT = 128 * 1024
+CHUNK_SIZE = 64 * 1024
+USER_AGENT = "Mozilla/5.0 (Windows NT 6.2; WOW64)"
 
 
 is_valid_host = re.compile(
@@ -52,6 +51,10 @@ is_valid_host = re.compile(
 
 search_simple_home_url = re.compile(r"https?://[-a-z0-9.]+").search
 
+search_meta_charset = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?([-_a-zA-Z0-9]{2,30})""", re.I
+).search
+
 
 def netloc_to_host(netloc):
     """获取到更符合规则的 HOST 字符串
@@ -101,30 +104,21 @@ def filter_links(base_host, links) -> (set, set):
     return inner_links, other_hosts
 
 
-def get_meta_tag_content(soup: bs4.BeautifulSoup, name: str) -> str or None:
-    """从 BeautifulSoup 对象中提取出指定名字的 meta 标签的内容
+class PageParser(html.parser.HTMLParser):
+    """一遍扫过 HTML, 不建树, 只取我们要的东西
+
+    title, meta keywords/description/refresh, 可见的文本, <a href>, <img src>.
+    可以一块一块地 `feed`, 文本最多留 `TEXT_LIMIT`.
 
-    keywords or Keywords or KEYWORDS
-    description or Description or DESCRIPTION
+    meta 的 name 不分大小写, keywords or Keywords or KEYWORDS:
 
-    >>> soup = bs4.BeautifulSoup('''
+    >>> p = PageParser()
+    >>> p.feed('''
     ... <meta name="Keywords" content="k1,k2" />
     ... <meta name="Description" content="NB!" />
-    ... ''', 'html.parser')
-    >>> get_meta_tag_content(soup, "keywords")
+    ... ''')
+    >>> p.meta["keywords"]
     'k1,k2'
-    """
-
-    assert name == name.lower(), name
-
-    for name in [name, name.capitalize(), name.upper()]:
-        tag = soup.select_one("meta[name={}]".format(name))
-        if tag:
-            return tag.get("content")
-
-
-def get_meta_redirect(soup: bs4.BeautifulSoup) -> str or None:
-    """从 BeautifulSoup 对象中提取重定向信息
 
     有些站点不是用到 301 302 重定向, 而是在返回的 HTML 中,
     用的带 `http-equiv` 属性的 meta 标签::
@@ -133,18 +127,168 @@ def get_meta_redirect(soup: bs4.BeautifulSoup) -> str or None:
 
     在这里我们简单认为主页的跳转最有处理价值, 因为实际场景中就是这样.
 
-    >>> soup = bs4.BeautifulSoup('''
-    ... <meta name="Keywords" content="k1,k2" />
-    ... <meta http-equiv="refresh" content="0; URL=http://foo.bar.com/q/p/">
-    ... ''', 'html.parser')
-    >>> get_meta_redirect(soup)
-    'http://foo.bar.com'
+    >>> p = PageParser()
+    >>> p.feed('''
+    ... <title> T </title><meta http-equiv="refresh" content="0; URL=http://foo.bar.com/q/p/">
+    ... <script>var a = "<a href=x>";</script><p>a<b>b</b>
+    ...   c </p><a href="/1">1</a><img src="/i.png">
+    ... ''')
+    >>> p.close()
+    >>> p.title, p.redirect, p.text, p.hrefs, p.srcs
+    ('T', 'http://foo.bar.com', 'T\\nab\\nc 1', ['/1'], ['/i.png'])
+    """
+
+    SKIPPED_TAGS = {"script", "style"}
+
+    def __init__(self):
+        super().__init__()
+        self.title = None
+        self.meta = {}
+        self.redirect = None
+        self.hrefs = []
+        self.srcs = []
+        self._title = None
+        self._skip = None
+        self._line = []
+        self._lines = []
+        self._text_size = 0
+
+    @property
+    def text(self):
+        return "\n".join(self._lines)[:TEXT_LIMIT]
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a" or tag == "img" or tag == "meta":
+            attrs = dict(attrs)
+        if tag == "a":
+            if attrs.get("href"):
+                self.hrefs.append(attrs["href"])
+        elif tag == "img":
+            self.srcs.append(attrs.get("src") or "")
+        elif tag == "meta":
+            name = (attrs.get("name") or "").lower()
+            if name in ("keywords", "description"):
+                self.meta.setdefault(name, attrs.get("content"))
+            elif (attrs.get("http-equiv") or "").lower() == "refresh" \
+                    and self.redirect is None:
+                result = search_simple_home_url(attrs.get("content") or "")
+                self.redirect = result and result.group()
+        elif tag in self.SKIPPED_TAGS:
+            self._skip = tag
+        elif tag == "title" and self.title is None:
+            self._title = []
+
+    def handle_endtag(self, tag):
+        if tag == self._skip:
+            self._skip = None
+        elif tag == "title" and self._title is not None:
+            self.title = "".join(self._title).strip()
+            self._title = None
+
+    def handle_data(self, data):
+        if self._skip:
+            return
+        if self._title is not None:
+            self._title.append(data)
+        if self._text_size > TEXT_LIMIT:
+            return
+        first, *others = data.split("\n")
+        self._line.append(first)
+        for line in others:
+            self._end_line()
+            self._line.append(line)
+
+    def _end_line(self):
+        line = "".join(self._line).strip()
+        self._line = []
+        if line:
+            self._lines.append(line)
+            self._text_size += len(line) + 1
+
+    def close(self):
+        super().close()
+        self._end_line()
+        if self._title is not None:  # <title> never closed
+            self.handle_endtag("title")
+
+
+def sniff_encoding(head: bytes, encoding: str or None) -> str:
+    """用 HTTP 头里的, 或者 <meta charset> 里的编码, 都不行再猜
+
+    "ISO-8859-1" 是 `requests` 在没有 charset 时给的默认值, 不算数.
+    `head` 是页面开头的一段, 可能在一个字的中间断开.
+
+    >>> sniff_encoding('<meta charset="gbk">中文'.encode("gbk"), "ISO-8859-1")
+    'gbk'
+    >>> sniff_encoding('中文'.encode("utf-8")[:-1], None)
+    'utf-8'
+    """
+
+    candidates = []
+    if encoding and encoding != "ISO-8859-1":
+        candidates.append(encoding)
+    m = search_meta_charset(head)
+    if m:
+        candidates.append(m.group(1).decode())
+    candidates += ["utf-8", "gb18030"]
+    for candidate in candidates:
+        try:
+            codecs.getincrementaldecoder(candidate)().decode(head)
+            return candidate
+        except (LookupError, UnicodeDecodeError):  # unknown encoding or decode error
+            pass
+    return "ISO-8859-1"
+
+
+class PageReader():
+    """把下载到的字节一块块喂给 `PageParser`, 边下载边解析
+
+    编码由开头的 `SNIFF_SIZE` 字节决定, 超过 `TOO_LONG` 就不要了,
+    整个页面不会留在内存里.
+
+    >>> r = PageReader(None)
+    >>> r.feed('<title>中文</title>'.encode("utf-8"))
+    True
+    >>> r.close()
+    >>> r.encoding, r.parser.title
+    ('utf-8', '中文')
     """
 
-    tag = soup.select_one("meta[http-equiv=refresh]")
-    if tag:
-        result = search_simple_home_url(tag.get("content"))
-        return result and result.group()
+    SNIFF_SIZE = 4096
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self.parser = PageParser()
+        self.size = 0
+        self._head = []
+        self._decoder = None
+
+    def feed(self, chunk: bytes) -> bool:
+        """False if too long"""
+
+        self.size += len(chunk)
+        if self.size > TOO_LONG:
+            return False
+        if self._decoder is None:
+            self._head.append(chunk)
+            if self.size >= self.SNIFF_SIZE:
+                self._start()
+        else:
+            self.parser.feed(self._decoder.decode(chunk))
+        return True
+
+    def _start(self):
+        head = b"".join(self._head)
+        self._head = None
+        self.encoding = sniff_encoding(head[:self.SNIFF_SIZE], self.encoding)
+        self._decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+        self.parser.feed(self._decoder.decode(head))
+
+    def close(self):
+        if self._decoder is None:
+            self._start()
+        self.parser.feed(self._decoder.decode(b"", final=True))
+        self.parser.close()
 
 
 def fetch(url: str, get: requests.Session.get) -> (dict, set, set, set) or None:
@@ -171,57 +315,46 @@ def fetch(url: str, get: requests.Session.get) -> (dict, set, set, set) or None:
     if not resp.headers.get("Content-Type", "").startswith("text/html"):
         return
 
-    if len(resp.content) > TOO_LONG:
-        return
+    reader = PageReader(resp.encoding)
+    for chunk in resp.iter_content(CHUNK_SIZE):
+        if not reader.feed(chunk):
+            resp.close()
+            return
+    reader.close()
+
+    return extract(page, resp.url, reader.parser, reader.encoding)
 
-    markup = resp.content
-    if resp.encoding != 'ISO-8859-1':
-        try:
-            markup = markup.decode(encoding=resp.encoding)
-        except (LookupError, UnicodeDecodeError):  # unknown encoding or decode error
-            pass
 
-    soup = bs4.BeautifulSoup(markup, HTML_PARSER)
+def extract(page: dict, url: str, parser: PageParser, encoding: str) -> (dict, set, set, set):
+    """把 `PageParser` 的结果整理成 `fetch` 的返回值
+    """
 
-    abs_url = functools.partial(urllib.parse.urljoin, resp.url)
+    parsed = urllib.parse.urlparse(url)
+    abs_url = functools.partial(urllib.parse.urljoin, url)
 
-    encoding = soup.original_encoding or resp.encoding
-    if encoding:
-        encoding = encoding[:30]
-    page["encoding"] = encoding
-    page["title"] = soup.title and soup.title.text.strip()
+    page["encoding"] = encoding and encoding[:30]
+    page["title"] = parser.title
 
     for meta_name in ["keywords", "description"]:
-        meta_tag_content = get_meta_tag_content(soup, meta_name)
+        meta_tag_content = parser.meta.get(meta_name)
         page[meta_name] = meta_tag_content and meta_tag_content.lower()
 
-    # see get_meta_tag_content.__doc__
-    html_meta_redirect = get_meta_redirect(soup)
-    if html_meta_redirect:
-        page["url"] = html_meta_redirect
+    # see PageParser.__doc__
+    if parser.redirect:
+        page["url"] = parser.redirect
 
-    for tag in soup.find_all(["script", "style"]):
-        tag.clear()
-
-    page["text"] = "\n".join(filter(None, map(
-        str.strip, soup.text.split("\n")
-    )))[:128*1024]  # trim
-
-    all_tag_a = soup.find_all("a")
+    page["text"] = parser.text
 
     links = list(filter(
         lambda url: url.startswith("http"),
-        set(
-            abs_url(url).partition("#")[0]
-            for url in map(lambda a: a.get("href"), all_tag_a) if url
-        )
+        set(abs_url(url).partition("#")[0] for url in parser.hrefs)
     ))
 
     inner_links, other_hosts = filter_links(parsed.netloc, links)
 
     images = set()
-    for img in soup.find_all("img"):
-        src = img.get("src", "").strip()
+    for src in parser.srcs:
+        src = src.strip()
         # how to prevent `data:image/jpeg;base64,...` ?
         if not src or len(src) > 256:
             continue
@@ -235,6 +368,87 @@ def fetch(url: str, get: requests.Session.get) -> (dict, set, set, set) or None:
     return page, inner_links, other_hosts, images
 
 
+class Crawl():
+    """一个 HOST 的抓取状态, 与具体怎么下载无关
+
+    迭代得到下一个要抓取的 URL, 用 `feed` 喂回 `fetch` 的结果,
+    最后用 `info` 得到交给 "hub" 的数据 (`HostInfoHandler.post`).
+    同步的 `run` 和 `robot2_async` 共用它.
+    """
+
+    def __init__(self, host, n_pages=1):
+        self.host = host
+        self.n_pages = n_pages
+        self.schema = "http"  # guess http first
+        url_root = "{}://{}".format(self.schema, host)
+        self.other_hosts_found = set()
+        self.images = set()
+        self.urls_todo = [url_root]  # only one
+        self.urls_done = {url_root, url_root + "/"}  # :)
+        self.pages = []
+        self.redirect = None
+        self.error = None
+
+    def __iter__(self):
+        for url in self.urls_todo:
+            if len(self.pages) >= self.n_pages or self.redirect:
+                break
+            yield url
+
+    def feed(self, url, result):
+        if result is None:
+            return
+
+        page, inner_links, other_hosts, _images = result
+        url_strict = page["url"]
+        home = not self.pages
+
+        self.urls_done.add(url)
+        self.urls_done.add(url_strict)
+        self.other_hosts_found.update(other_hosts)
+        self.images.update(_images)
+        self.urls_todo.extend(inner_links - self.urls_done)  # dangerous, hold it!
+        self.pages.append(page)
+
+        if home:  # home page, tiny special
+            if url_strict.startswith("https"):
+                self.schema = "https"
+            base_host_new = netloc_to_host(
+                urllib.parse.urlparse(url_strict).netloc)
+            if self.host != base_host_new:
+                self.redirect = base_host_new  # then "hub" should add base_host_new
+
+    def fail(self, e):
+        self.error = e
+        logging.exception(e)
+
+    def info(self, ip=None):
+        if self.redirect:
+            return {
+                "redirect": self.redirect,
+                "ip": ip,
+                "pages": self.pages,
+            }
+
+        info = {
+            "schema": self.schema,
+            #"other_hosts_found": list(other_hosts_found)[:200],
+            #"images": list(images)[:300],
+            "other_hosts_found": list(self.other_hosts_found),
+            "images": list(self.images)[:300],
+            "pages": self.pages,
+        }
+
+        if self.error is not None:
+            info["err"] = str(type(self.error))[8:-2]
+            info["error"] = str(self.error)
+
+        if ip:
+            info["ip"] = ip
+
+        return info
+
+
 @click.command()
 @click.option("--host", "-h", prompt="Host")
 @click.option("--count", "-n", default=1, help="Number of pages")
@@ -259,80 +473,30 @@ def run(**config):
         "https": proxy,
     } if proxy else None
 
-    schema = "http"  # guess http first
-    url_root = "{}://{}".format(schema, host)
-    other_hosts_found = set()
-    images = set()
-    urls_todo = [url_root]  # only one
-    urls_done = {url_root, url_root + "/"}  # :)
-    pages = []
-    error_message = None
+    crawl = Crawl(host, n_pages)
     ip = None
 
-    base_host = host
-
     try:
         ip = socket.gethostbyname(host)  # prefetch
 
         session_for_fetch = requests.Session()
-        session_for_fetch.headers["User-Agent"] = "Mozilla/5.0 (Windows NT 6.2; WOW64)"
+        session_for_fetch.headers["User-Agent"] = USER_AGENT
         get_method = functools.partial(session_for_fetch.get,
                                        timeout=(10, 20),
                                        proxies=proxies,
                                        verify=False)
 
-        for idx, url in enumerate(urls_todo):
-            if len(pages) >= n_pages:
-                break
-
+        for url in crawl:
             try:
-                page, inner_links, other_hosts, _images = fetch(url, get_method)
+                result = fetch(url, get_method)
             except TypeError:
                 continue
-
-            url_strict = page["url"]
-
-            urls_done.add(url)
-            urls_done.add(url_strict)
-            other_hosts_found.update(other_hosts)
-            images.update(_images)
-            urls_todo.extend(inner_links - urls_done)  # dangerous, hold it!
-            pages.append(page)
-
-            if idx == 0:  # home page, tiny special
-                if url_strict.startswith("https"):
-                    schema = "https"
-                base_host_new = netloc_to_host(
-                    urllib.parse.urlparse(url_strict).netloc)
-                if base_host != base_host_new:
-                    return {
-                        "redirect": base_host_new,  # then "hub" should add base_host_new
-                        "ip": ip,
-                        "pages": pages,
-                    }
+            crawl.feed(url, result)
 
     except Exception as e:
-        error_message = str(e)
-        error_type = type(e)
-        logging.exception(e)
-
-    info = {
-        "schema": schema,
-        #"other_hosts_found": list(other_hosts_found)[:200],
-        #"images": list(images)[:300],
-        "other_hosts_found": list(other_hosts_found),
-        "images": list(images)[:300],
-        "pages": pages,
-    }
-
-    if error_message:
-        info["err"] = str(error_type)[8:-2]
-        info["error"] = error_message
+        crawl.fail(e)
 
-    if ip:
-        info["ip"] = ip
-
-    return info
+    return crawl.info(ip)
 
 
 def main(spec_task=None):
@@ -353,25 +517,42 @@ def main(spec_task=None):
             break
 
 
+def dumps(info: dict) -> bytes:
+    """把 `run` 的结果编码成紧凑的 JSON, 没有换行
+
+    再经过 `codec.encode` 就是交给 "hub" 的记录.
+    """
+
+    return json.dumps(info, default=str, ensure_ascii=False,
+                      separators=(",", ":")).encode()
+
+
 session_to_hub = requests.Session()
 
 HUB_HOST = os.getenv("HUB_HOST", "localhost:1033")
 
 def do_it(host_name=None):
+    headers = {}
     if host_name is None:
         resp = session_to_hub.get("http://{}/host".format(HUB_HOST))
         if resp.status_code != 200:
             return "break"
         host_name = resp.json()["host"]
+        if codec.accepted(resp.headers):
+            headers["Content-Type"] = codec.RECORD_TYPE
 
     print(host_name, flush=True)
     info = run(host=host_name, n_pages=25)
-    data = json.dumps(info, default=str, ensure_ascii=False, indent=4,
-                      sort_keys=True, separators=(",", ": ")).encode()
-    session_to_hub.post(
-        "http://{}/host-info/{}".format(HUB_HOST, host_name),
-        data=data,
-    )
+    data = dumps(info)
+    if headers:
+        data = codec.encode(data)
+    url = "http://{}/host-info/{}".format(HUB_HOST, host_name)
+    while True:
+        resp = session_to_hub.post(url, data=data, headers=headers)
+        if resp.status_code != 503:
+            break
+        # "hub" 忙不过来, 过 Retry-After 秒再交
+        time.sleep(int(resp.headers.get("Retry-After", 5)))
 
 
 if __name__ == "__main__":
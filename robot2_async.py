@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+"""
+robot2_async.py
+
+和 robot2.py 抓的东西一样, 但一个进程里用 asyncio 同时抓几百个 HOST,
+不再一个进程一个 HOST.
+"""
+
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import urllib.parse
+
+import aiohttp
+import yarl
+
+import codec
+import hash_ring
+import resolver
+import robot2
+
+
+HUB_HOST = os.getenv("HUB_HOST", "localhost:1033")
+CONCURRENCY = int(os.getenv("CONCURRENCY", 200))
+N_PAGES = 10
+HOST_TIMEOUT = 300  # the same as `time_for_running` in robot2_master_worker
+PREFETCH = int(os.getenv("PREFETCH", 50))
+RESULTS_BATCH = 50
+RESULTS_FLUSH_INTERVAL = 5
+HOSTS_PER_IP = int(os.getenv("HOSTS_PER_IP", 2))
+PER_IP_INTERVAL = float(os.getenv("PER_IP_INTERVAL", 0.2))
+MAX_WAITING_PER_IP = int(os.getenv("MAX_WAITING_PER_IP", 20))
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+MAX_REDIRECTS = 10
+
+
+async def fetch(url, engine, jar=None):
+    """异步版的 `robot2.fetch`, 解析仍然是 `robot2.PageReader`
+
+    重定向自己跟, 因为 `Engine.get` 可能把 URL 换成了 IP; 也因为这样,
+    cookie 记在 `jar` 里, 按原来的 URL 存取, 和 `requests.Session` 一样.
+    """
+
+    page = {}
+    for _ in range(MAX_REDIRECTS + 1):
+        async with await engine.get(url, jar) as resp:
+            if jar is not None:
+                jar.update_cookies(resp.cookies, yarl.URL(url))
+            location = resp.headers.get("Location")
+            if resp.status in REDIRECT_CODES and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+
+            page["url"] = url
+            page["path"] = urllib.parse.urlparse(url).path
+            page["code"] = resp.status
+
+            if resp.status >= 300:
+                return
+
+            if int(resp.headers.get("Content-Length", 0)) > robot2.TOO_LONG:
+                return
+
+            if not resp.headers.get("Content-Type", "").startswith("text/html"):
+                return
+
+            # the same default as `requests` for "text/*"
+            reader = robot2.PageReader(resp.charset or "ISO-8859-1")
+            async for chunk in resp.content.iter_chunked(robot2.CHUNK_SIZE):
+                if not reader.feed(chunk):
+                    return
+            reader.close()
+
+        return robot2.extract(page, url, reader.parser, reader.encoding)
+
+
+class Politeness():
+    """按 IP 限制: 同一个 IP 上同时最多抓 `hosts_per_ip` 个 HOST,
+    发给同一个 IP 的请求之间至少隔 `interval` 秒.
+
+    IP 忙的时候, HOST 先在 `waiting` 里排队, 由正在抓这个 IP 的
+    worker 抓完手上的之后接着抓, 连接也就接着用. 每个 IP 最多排
+    `max_waiting` 个, 再多的 `defer` 返回 False, 还给 "hub".
+    """
+
+    def __init__(self, hosts_per_ip=HOSTS_PER_IP, interval=PER_IP_INTERVAL,
+                 max_waiting=MAX_WAITING_PER_IP):
+        self.hosts_per_ip = hosts_per_ip
+        self.interval = interval
+        self.max_waiting = max_waiting
+        self.active = collections.Counter()
+        self.waiting = collections.defaultdict(collections.deque)
+        self.n_waiting = 0
+        self._next = {}
+
+    def busy(self, ip):
+        return self.active[ip] >= self.hosts_per_ip
+
+    def defer(self, ip, host):
+        if len(self.waiting[ip]) >= self.max_waiting:
+            return False
+        self.waiting[ip].append(host)
+        self.n_waiting += 1
+        return True
+
+    def drain(self):
+        """all the waiting hosts, removed"""
+        hosts = [host for hosts in self.waiting.values() for host in hosts]
+        self.waiting.clear()
+        self.n_waiting = 0
+        return hosts
+
+    def next_waiting(self, ip):
+        hosts = self.waiting.get(ip)
+        if not hosts:
+            return
+        host = hosts.popleft()
+        if not hosts:
+            del self.waiting[ip]
+        self.n_waiting -= 1
+        return host
+
+    def enter(self, ip):
+        self.active[ip] += 1
+
+    def leave(self, ip):
+        self.active[ip] -= 1
+        if not self.active[ip]:
+            del self.active[ip]
+
+    async def wait(self, ip):
+        now = asyncio.get_event_loop().time()
+        if len(self._next) > 100000:
+            self._next = {k: v for k, v in self._next.items() if v > now}
+        t = max(now, self._next.get(ip, 0))
+        self._next[ip] = t + self.interval
+        if t > now:
+            await asyncio.sleep(t - now)
+
+
+class Engine():
+    """在一个 event loop 里同时跑很多个 `robot2.Crawl`
+
+    每个 HOST 最多抓 `n_pages` 页, 总共同时在抓的 HOST 最多 `concurrency` 个,
+    同一个 IP 上的见 `Politeness`.
+    """
+
+    def __init__(self, concurrency=CONCURRENCY, n_pages=N_PAGES, proxy=None):
+        self.concurrency = concurrency
+        self.n_pages = n_pages
+        self.proxy = proxy and ("http://" + proxy if "://" not in proxy else proxy)
+        self.loop_flag = True
+        self.session = None
+        self.resolver = None
+        self.politeness = Politeness()
+        self.tasks = collections.deque()
+        self._tasks_lock = asyncio.Lock()
+        self.results = []
+        self.given_back = []
+        self.framed = False
+        self.shards = None
+
+    async def open(self):
+        self.resolver = resolver.CachingResolver()
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, ssl=False,
+                                           resolver=self.resolver,
+                                           family=socket.AF_INET,
+                                           use_dns_cache=False),
+            timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=20),
+            headers={"User-Agent": robot2.USER_AGENT},
+            cookie_jar=aiohttp.DummyCookieJar(),  # IP URLs, see `fetch`
+        )
+
+    async def close(self):
+        await self.session.close()
+
+    async def get(self, url, jar=None):
+        """http 的请求直接发给 IP, 带上 Host 头, 这样同一个 IP 上的
+        不同站点能共用 keep-alive 的连接; https 要 SNI, 不能这样.
+        """
+
+        parsed = urllib.parse.urlparse(url)
+        ip = await self.resolve(parsed.hostname)
+        await self.politeness.wait(ip)
+        headers = {}
+        if jar is not None:
+            cookies = jar.filter_cookies(yarl.URL(url))
+            if cookies:
+                headers["Cookie"] = "; ".join(
+                    "{}={}".format(k, v.value) for k, v in cookies.items())
+        if parsed.scheme == "http" and not self.proxy:
+            headers["Host"] = parsed.netloc
+            netloc = ip if parsed.port is None else "{}:{}".format(ip, parsed.port)
+            url = parsed._replace(netloc=netloc).geturl()
+        return self.session.get(url, headers=headers, proxy=self.proxy,
+                                allow_redirects=False)
+
+    async def resolve(self, host):
+        """the connection later gets the same answer from `self.resolver`"""
+        host = host.partition(":")[0]
+        hosts = await self.resolver.resolve(host, 80, socket.AF_INET)
+        return hosts[0]["host"]
+
+    async def run(self, host, n_pages=None):
+        """返回和 `robot2.run` 一样的 info
+        """
+
+        crawl = robot2.Crawl(host, n_pages or self.n_pages)
+        jar = aiohttp.CookieJar()
+        ip = None
+
+        async def _crawl():
+            nonlocal ip
+            ip = await self.resolve(host)  # prefetch
+            for url in crawl:
+                crawl.feed(url, await fetch(url, self, jar))
+
+        try:
+            await asyncio.wait_for(_crawl(), HOST_TIMEOUT)
+        except Exception as e:
+            crawl.fail(e)
+
+        return crawl.info(ip)
+
+    async def get_task(self):
+        """从本地缓冲里取一个 HOST, 空了就一次向 "hub" 要 `PREFETCH` 个
+        """
+
+        url = "http://{}/host?n={}".format(HUB_HOST, PREFETCH)
+        async with self._tasks_lock:  # only one coroutine refills the buffer
+            while self.loop_flag and not self.tasks:
+                try:
+                    async with self.session.get(url) as resp:
+                        if resp.status == 200:
+                            self.framed = codec.accepted(resp.headers)
+                            self.tasks.extend((await resp.json())["hosts"])
+                            break
+                except Exception as e:
+                    logging.exception(e)
+                await asyncio.sleep(0.1)
+            if self.tasks:
+                return self.tasks.popleft()
+
+    async def put_result(self, host, info):
+        self.results.append((host, codec.encode(robot2.dumps(info))))
+        if len(self.results) >= RESULTS_BATCH:
+            await self.flush_results()
+
+    async def flush_results(self):
+        if not self.results:
+            return
+        shards = await self.hub_shards()
+        results, self.results = self.results, []
+        for address, records in shards.split(results).items():
+            url = "http://{}/host-info".format(address)
+            data, headers = codec.batch(records, self.framed)
+            try:
+                async with self.session.post(url, data=data, headers=headers) as resp:
+                    body = await resp.read()
+                    self.results.extend(codec.resend(records, resp.status, body))
+            except Exception as e:
+                logging.exception(e)  # the hub requeues them when their leases expire
+                self.shards = None
+
+    async def hub_shards(self):
+        if self.shards is None:
+            async with self.session.get("http://{}/shards".format(HUB_HOST)) as resp:
+                ports = (await resp.json())["ports"] if resp.status == 200 else None
+            self.shards = hash_ring.HubShards(HUB_HOST, ports)
+        return self.shards
+
+    async def give_back(self):
+        """the hosts leased but not to be crawled here, to the end of the queue"""
+        if not self.given_back:
+            return
+        hosts, self.given_back = self.given_back, []
+        url = "http://{}/host?giveback=1".format(HUB_HOST)
+        async with self.session.post(url, data="\n".join(hosts)) as resp:
+            await resp.read()
+
+    async def flusher(self):
+        while self.loop_flag:
+            await asyncio.sleep(RESULTS_FLUSH_INTERVAL)
+            try:
+                await self.flush_results()
+                await self.give_back()
+            except Exception as e:
+                logging.exception(e)
+
+    async def worker(self):
+        while self.loop_flag:
+            host = await self.get_task()
+            if host is None:
+                break
+            try:
+                ip = await self.resolve(host)
+            except Exception:
+                ip = None  # `run` reports it
+            if not self.loop_flag:
+                self.given_back.append(host)
+                break
+            if ip and self.politeness.busy(ip):
+                if not self.politeness.defer(ip, host):
+                    self.given_back.append(host)
+                continue
+
+            # 占着这个 IP 的名额, 直到排在它后面的 HOST 都抓完
+            self.politeness.enter(ip)
+            try:
+                while host:
+                    print(host, flush=True)
+                    info = await self.run(host)
+                    try:
+                        await self.put_result(host, info)
+                    except Exception as e:
+                        logging.exception(e)
+                    host = ip and self.loop_flag and self.politeness.next_waiting(ip)
+            finally:
+                self.politeness.leave(ip)
+
+    async def serve(self):
+        await self.open()
+        try:
+            await asyncio.gather(self.flusher(),
+                                 *(self.worker() for _ in range(self.concurrency)))
+            await self.flush_results()
+            self.given_back.extend(self.politeness.drain())
+            self.given_back.extend(self.tasks)
+            self.tasks.clear()
+            await self.give_back()
+        finally:
+            await self.close()
+
+    def stop(self, *_):
+        self.loop_flag = False
+
+
+def main(spec_task=None):
+    engine = Engine()
+    loop = asyncio.get_event_loop()
+
+    if spec_task:
+        async def _one():
+            await engine.open()
+            try:
+                return await engine.run(spec_task)
+            finally:
+                await engine.close()
+        return print(json.dumps(loop.run_until_complete(_one()), default=str,
+                                ensure_ascii=False, indent=4, sort_keys=True))
+
+    loop.add_signal_handler(signal.SIGTERM, engine.stop)
+    loop.run_until_complete(engine.serve())
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
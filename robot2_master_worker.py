@@ -16,6 +16,8 @@ import uuid
 
 import requests
 
+import codec
+import hash_ring
 import robot2
 import master_worker
 import random
@@ -38,21 +40,37 @@ class Cli(master_worker.MasterWorker):
     NUM_OF_WORKERS = 1
     RLIMIT_CPU = 240 - 3
     RLIMIT_AS = 500 * 1024 * 1024
+    PREFETCH = int(os.getenv("PREFETCH", 20))  # at most, see `prefetch`
+    MAX_RUNNING = 300  # seconds, `mailer` kills a host running longer
+    LEASE_TIMEOUT = int(os.getenv("LEASE_TIMEOUT", 1800))  # as the hub's
+    RESULTS_BATCH = 20
+    RESULTS_FLUSH_INTERVAL = 5
 
     def init(self):
-        self.session = requests.Session()
+        self.session = SessionWithLock()  # shared with `flusher`
         self.proxy = None
+        self.tasks = collections.deque()
+        self.results = []
+        self.results_flushed = time.time()
+        self._results_lock = threading.Lock()
+        self.framed = False
+        self.shards = None
 
     def get_command(self):
-        url_task_ask = "http://{}/host".format(HUB_HOST)
+        if self.tasks:
+            return self.tasks.popleft()
+
+        url_task_ask = "http://{}/host?n={}".format(HUB_HOST, self.prefetch())
 
         while True:
             try:
                 task = self.session.get(url_task_ask)
                 if task.status_code == 200:
-                    resp = task.json()
-                    return resp["host"]
+                    self.framed = codec.accepted(task.headers)
+                    self.tasks.extend(task.json()["hosts"])
+                    return self.tasks.popleft()
                 else:
+                    self.flush_results(force=True)
                     self.log("have a rest")
                     time.sleep(0.1)
 
@@ -60,15 +78,73 @@ class Cli(master_worker.MasterWorker):
                 self.log(e)
                 time.sleep(0.1)
 
+    def prefetch(self):
+        """hosts leased at once: the last one is done before its lease
+        expires even if all the ones before it run `MAX_RUNNING`
+        """
+
+        n = self.NUM_OF_WORKERS * (self.LEASE_TIMEOUT // self.MAX_RUNNING - 1)
+        return max(1, min(self.PREFETCH, n))
+
+    def give_back(self):
+        """the leased hosts not crawled yet, to the end of the queue"""
+        if not self.tasks:
+            return
+        hosts = list(self.tasks)
+        self.tasks.clear()
+        try:
+            self.session.post("http://{}/host?giveback=1".format(HUB_HOST),
+                              data="\n".join(hosts))
+        except Exception as e:
+            self.log(e)  # the hub requeues them when their leases expire
+
     def work(self, host):
         info = robot2.run(host=host, n_pages=10, proxy=self.proxy)
-        data = json.dumps(info, default=str, ensure_ascii=False, indent=4,
-                          sort_keys=True, separators=(",", ": ")).encode()
-        return data
+        return codec.encode(robot2.dumps(info))
 
     def process_result(self, host, data):
-        url = "http://{}/host-info/{}".format(HUB_HOST, host)
-        self.session.post(url, data=data)
+        with self._results_lock:
+            self.results.append((host, data))
+        self.flush_results()
+
+    def flush_results(self, force=False):
+        """POST buffered results in one body, by size or by time
+        """
+
+        with self._results_lock:
+            self._flush_results(force)
+
+    def _flush_results(self, force):
+        if not self.results:
+            return
+        if not force and len(self.results) < self.RESULTS_BATCH and \
+                time.time() - self.results_flushed < self.RESULTS_FLUSH_INTERVAL:
+            return
+
+        try:
+            shards = self.hub_shards()
+        except Exception as e:
+            return self.log(e)
+
+        busy = []
+        for address, results in shards.split(self.results).items():
+            url = "http://{}/host-info".format(address)
+            data, headers = codec.batch(results, self.framed)
+            try:
+                resp = self.session.post(url, data=data, headers=headers)
+                busy.extend(codec.resend(results, resp.status_code, resp.content))
+            except Exception as e:
+                self.log(e)  # the hub requeues them when their leases expire
+                self.shards = None
+        self.results = busy
+        self.results_flushed = time.time()
+
+    def hub_shards(self):
+        if self.shards is None:
+            resp = self.session.get("http://{}/shards".format(HUB_HOST))
+            ports = resp.json()["ports"] if resp.status_code == 200 else None
+            self.shards = hash_ring.HubShards(HUB_HOST, ports)
+        return self.shards
 
     def cmd__reload(self):
         imp.reload(robot2)
@@ -90,7 +166,7 @@ def mailer():
     )
     url = "http://{}/mail/{}".format(HUB_HOST, id)
 
-    time_for_running = datetime.timedelta(seconds=300)
+    time_for_running = datetime.timedelta(seconds=master_worker.MAX_RUNNING)
 
     f_for_this_thread = open("log/mailer.log", "a")
     while True:
@@ -126,10 +202,24 @@ def mailer():
     f_for_this_thread.close()
 
 
+def flusher():
+    """the buffered results, also when no more come (e.g. the hub has no task)"""
+    while master_worker.loop_flag:
+        time.sleep(master_worker.RESULTS_FLUSH_INTERVAL)
+        master_worker.flush_results()
+
+
 def main():
     #return mailer()
     threading.Thread(target=mailer).start()
-    master_worker.run()
+    threading.Thread(target=flusher, daemon=True).start()
+    pid = os.getpid()
+    try:
+        master_worker.run()
+    finally:
+        if os.getpid() == pid:  # not in a forked worker
+            master_worker.flush_results(force=True)
+            master_worker.give_back()
 
 
 if __name__ == "__main__":
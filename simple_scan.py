@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import re
 import binascii
 import os
 import datetime
@@ -8,9 +7,11 @@ import gzip
 import os.path
 import json
 import collections
-import multiprocessing
 import sys
 
+import aho_corasick
+import parallel_scan
+
 
 def hash_name(s):
     crc = "{:08x}".format(binascii.crc32(s.encode()))
@@ -22,7 +23,7 @@ xxx
 xnxx
 sex
 porn
-\.sucks
+.sucks
 hentai
 gay
 lesbian
@@ -66,12 +67,9 @@ nude
 """
 
 
-def to_pattern_sting(s):
-    return "|".join(map("({})".format, set(s.split())))
-
-
-domain_pattern = re.compile(to_pattern_sting(domain_names))
-kw_pattern = re.compile(to_pattern_sting(kw))
+domain_matcher = aho_corasick.Matcher(domain_names.split())
+kw_matcher = aho_corasick.Matcher(kw.split())
+FIELDS = "title", "keywords", "description"
 
 
 def g():
@@ -111,10 +109,7 @@ def g():
 
 
 def get_flag(s):
-    if s:
-        if kw_pattern.search(s.lower()):
-            return 1
-    return 0
+    return int(kw_matcher.search(s))
 
 
 def page1(data):
@@ -128,6 +123,21 @@ def page1(data):
     return flag_title, flag_keywords, flag_description
 
 
+def page1_many(datas):
+    """`page1` of many results at once, with the keywords found in each:
+    [((flag_title, flag_keywords, flag_description), {term, ...}), ...]
+    """
+
+    texts = []
+    for data in datas:
+        pages = data.get("pages")
+        p = pages[0] if pages else {}
+        texts.extend(p.get(k) for k in FIELDS)
+    found = kw_matcher.findall_many(texts)
+    return [(tuple(int(bool(i)) for i in found[j:j + 3]), set().union(*found[j:j + 3]))
+            for j in range(0, len(found), 3)]
+
+
 def pages(data):
     flag_title = flag_keywords = flag_description = 0
     idx = 0
@@ -143,40 +153,37 @@ def pages(data):
     return tuple(i * (1 - idx*0.01) for i in [flag_title, flag_keywords, flag_description])
 
 
-def get_info(args):
-    fn_full, data = args
-    try:
-        data = json.loads(data)
-    except json.JSONDecodeError:
-        return
+def get_pages_info(fn_full, data):
+    f1, f2, f3 = pages(data)
+    f0 = int(domain_matcher.search(fn_full))
+    return fn_full[9:], f0, f1, f2, f3
 
-    f0 = int(bool(domain_pattern.search(fn_full)))
-    f1, f2, f3 = page1(data)
 
-    return f0, f1, f2, f3, f0+f1+f2+f3, fn_full[9:]
+def scan_pages(name, value):
+    """`get_pages_info` for `parallel_scan`"""
+    try:
+        data = json.loads(value.decode())
+    except ValueError:
+        return
+    return get_pages_info(hash_name(name), data)
 
 
-def get_pages_info(fn_full, data):
-    f1, f2, f3 = pages(data)
-    f0 = int(bool(domain_pattern.search(fn_full)))
-    return fn_full[9:], f0, f1, f2, f3
+def main(path=None, workers=None):
+    """
+    ./simple_scan.py                         # the hosts in all_domains_from_xh.1
+    ./simple_scan.py hosts.ldb|fs [workers]  # all of them, in parallel
+    """
 
+    if path is None:
+        for i in g():
+            out = get_pages_info(*i)
+            print(*out, sep="\t")
+        return
 
-def main():
-    #for n, i in zip(range(10), g()):
-    for i in g():
-        out = get_pages_info(*i)
+    source = parallel_scan.source_of(path)
+    for out in parallel_scan.scan(source, scan_pages, workers and int(workers)):
         print(*out, sep="\t")
-    return
-    n = 0
-    with multiprocessing.Pool(os.cpu_count() - 4) as pool:
-        for out in pool.imap_unordered(get_info, g()):
-            if out:
-                print(*out, sep="\t")
-            n += 1
-            if n > 10:
-                break
 
 
 if __name__ == "__main__":
-    main()
+    main(*sys.argv[1:])
@@ -1,46 +1,117 @@
 #!/usr/bin/env python3
 
+import collections
+import concurrent.futures
 import sqlite3
+import sys
 import zlib
 import functools
 import threading
 
 
 class Set(object):
+    """A set of strings in `base` SQLite files, sharded by adler32
+
+    threads: run the shards of one call on a thread pool, sqlite3 releases
+        the GIL while it works. A shard is only used by one thread at a time,
+        but the Set itself must not be shared between threads.
+    durable: WAL journal and `synchronous = normal`, so a crash loses at
+        most the last commits and never corrupts a shard. The default is fast
+        but not crash-safe.
+    checkpoint: WAL pages before an automatic checkpoint (SQLite's
+        wal_autocheckpoint), 0 to only checkpoint in `checkpoint()`.
+
+    Every shard keeps its number of keys in `meta`, updated in the same
+    transaction as the keys, so `len` reads no table. Shards created before
+    that are counted once when first opened; `reconcile` recounts them all.
+    """
+
+    MAX_VARIABLES = 500  # SQLITE_MAX_VARIABLE_NUMBER is 999 by default
     SQL_CREATE = """
     CREATE TABLE IF NOT EXISTS t (
         k TEXT PRIMARY KEY
     )
     """
+    SQL_CREATE_META = """
+    CREATE TABLE IF NOT EXISTS meta (
+        name TEXT PRIMARY KEY,
+        value INTEGER
+    )
+    """
 
-    def __init__(self, base=0x10, name="set-dbs"):
+    def __init__(self, base=0x10, name="set-dbs", threads=0, durable=False,
+                 checkpoint=1000):
         self.base = base
         self._cache = {}
-        self._dbs = [sqlite3.connect("{}/{:02x}".format(name, i))
+        self._dbs = [sqlite3.connect("{}/{:02x}".format(name, i),
+                                     check_same_thread=not threads)
                      for i in range(base)]
         self._cursors = [db.cursor() for db in self._dbs]
-        self._counter = [0] * base
+        self._pool = threads and concurrent.futures.ThreadPoolExecutor(threads)
         for db in self._dbs:
-            db.execute("PRAGMA synchronous = off")
+            if durable:
+                db.execute("PRAGMA journal_mode = wal")
+                db.execute("PRAGMA synchronous = normal")
+                db.execute("PRAGMA wal_autocheckpoint = {:d}".format(checkpoint))
+            else:
+                db.execute("PRAGMA synchronous = off")
+                db.execute("PRAGMA journal_mode = memory")
             db.execute("PRAGMA temp_store = memory")
-            db.execute("PRAGMA journal_mode = memory")
             db.execute("PRAGMA secure_delete = false")
             db.execute(self.SQL_CREATE)
+            db.execute(self.SQL_CREATE_META)
+            db.commit()
+        self._counts = [self._count(db) for db in self._dbs]
+
+    @staticmethod
+    def _count(db):
+        """the count in `meta`, counted and kept there if it is missing"""
+        row = db.execute("SELECT value FROM meta WHERE name = 'count'").fetchone()
+        if row:
+            return row[0]
+        n = db.execute("SELECT COUNT(k) FROM t").fetchone()[0]
+        db.execute("INSERT INTO meta VALUES ('count', ?)", (n,))
+        db.commit()
+        return n
 
     def __del__(self):
         self.close()
 
     def __len__(self):
-        n = 0
-        for c in self._cursors:
-            c.execute("SELECT COUNT(k) FROM t")
-            n += c.fetchone()[0]
-        return n
+        return sum(self._counts)
+
+    def reconcile(self) -> int:
+        """recount every shard, returns how far `len` was off"""
+        def count(idx, _):
+            db = self._dbs[idx]
+            n = db.execute("SELECT COUNT(k) FROM t").fetchone()[0]
+            db.execute("UPDATE meta SET value = ? WHERE name = 'count'", (n,))
+            db.commit()
+            return n
+        before = len(self)
+        self._counts = self._map(count, enumerate([None] * self.base))
+        return len(self) - before
 
     def close(self):
+        if self._pool:
+            self._pool.shutdown()
+            self._pool = None
         for db in self._dbs:
             db.close()
 
+    def _map(self, f, shards):
+        """[f(idx, items) for idx, items in shards], maybe in parallel"""
+        if self._pool:
+            return list(self._pool.map(lambda args: f(*args), shards))
+        return [f(idx, items) for idx, items in shards]
+
+    def checkpoint(self, mode="truncate"):
+        """PRAGMA wal_checkpoint on every shard, only for `durable`"""
+        def f(idx, _):
+            return self._dbs[idx].execute(
+                "PRAGMA wal_checkpoint({})".format(mode)).fetchone()
+        return self._map(f, enumerate([None] * self.base))
+
     @functools.lru_cache(maxsize=100000)
     def index(self, key):
         return zlib.adler32(key.encode()) % self.base
@@ -63,41 +134,101 @@ class Set(object):
         for db in self._dbs:
             db.execute("DROP TABLE t")
             db.execute(self.SQL_CREATE)
+            db.execute("UPDATE meta SET value = 0 WHERE name = 'count'")
+            db.commit()
+        self._counts = [0] * self.base
+
+    def _shards(self, keys):
+        shards = collections.defaultdict(list)
+        for key in keys:
+            shards[self.index(key)].append(key)
+        return list(shards.items())
+
+    def contains_many(self, keys) -> list:
+        """[key in self for key in keys], one SELECT per shard per 500 keys
+        """
+
+        keys = list(keys)
+        found = {}
+        unknown = []
+        for key in keys:
+            if key in self._cache:
+                found[key] = self._cache[key]
+            else:
+                unknown.append(key)
+
+        def select(idx, shard_keys):
+            c = self._cursors[idx]
+            existed = set()
+            for i in range(0, len(shard_keys), self.MAX_VARIABLES):
+                chunk = shard_keys[i:i + self.MAX_VARIABLES]
+                c.execute("SELECT k FROM t WHERE k IN ({})".format(
+                    ",".join("?" * len(chunk))), chunk)
+                existed.update(k for k, in c)
+            return existed
+
+        existed = set().union(*self._map(select, self._shards(unknown)))
+        for key in unknown:
+            found[key] = key in existed
+
+        return [found[key] for key in keys]
 
     def _batched(sql, alive:bool):
+        """keys grouped by shard, one `executemany` and one commit per shard
         """
-        """
 
-        def method(self, *keys):
+        sign = 1 if alive else -1
+
+        def method(self, keys):
             if len(self._cache) > 50000:
                 self._cache.clear()
                 self._contains.cache_clear()
-            for key in keys:
-                idx = self.index(key)
+            def write(idx, shard_keys):
                 c = self._cursors[idx]
-                c.execute(sql, (key,))
-                if c.rowcount:
-                    self._counter[idx] += c.rowcount
-                    self._cache[key] = alive
-            n_all = 0
-            for idx, n in enumerate(self._counter):
+                c.executemany(sql, ((key,) for key in shard_keys))
+                n = c.rowcount
                 if n:
-                    n_all += n
-                    #print(idx, n)
-                    self._dbs[idx].commit()
-                    self._counter[idx] = 0
-            assert not any(self._counter)
+                    c.execute("UPDATE meta SET value = value + ? WHERE name = 'count'",
+                              (sign * n,))
+                self._dbs[idx].commit()
+                self._counts[idx] += sign * n
+                return n
+
+            shards = self._shards(keys)
+            n_all = sum(self._map(write, shards))
+            for _, shard_keys in shards:
+                for key in shard_keys:
+                    self._cache[key] = alive
             return n_all
 
         return method
 
-    add = _batched("INSERT OR IGNORE INTO t(k) VALUES(?)", True)
-    remove = _batched("DELETE FROM t WHERE k = ?", False)
-    discard = remove
+    add_many = _batched("INSERT OR IGNORE INTO t(k) VALUES(?)", True)
+    remove_many = _batched("DELETE FROM t WHERE k = ?", False)
     del _batched
 
+    def add(self, *keys):
+        return self.add_many(keys)
+
+    def remove(self, *keys):
+        return self.remove_many(keys)
+
+    discard = remove
+
+
+def main(cmd=None, name=None, base=0x100):
+    """
+    ./sqliteset.py len hosts/queue.set [base]
+    ./sqliteset.py reconcile hosts/queue.set [base]
+    """
+
+    if cmd in ("len", "reconcile"):
+        s = Set(int(base), name)
+        if cmd == "reconcile":
+            print(s.reconcile())
+        print(len(s))
+        return s.close()
 
-def main():
     s = Set(256)
     #s.clear()
     l = []
@@ -117,4 +248,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    main(*sys.argv[1:])
@@ -1,6 +1,7 @@
 #ls -l hosts.bf
-du -sh hosts.ldb/
+du -sh hosts.ldb*/
 du -sh hosts/queue.set/
+./sqliteset.py len hosts/queue.set
 du -sh hosts/ignored.set/
 wc -l hosts/queue
 echo $(cat hosts/.pos.queue)/$(stat -c "%s" hosts/queue)
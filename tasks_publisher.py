@@ -3,72 +3,253 @@
 import contextlib
 import hashlib
 import itertools
+import math
+import mmap
 import pathlib
+import struct
 import threading
 import time
 import sys
 
-import bitarray
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from sqliteset import Set
 
-class BloomFilterMD5():
-    BITARRAY_LENGTH = 2 ** 32
-    NUM_OF_BITARRAY = 3
 
-    def __init__(self, folder):
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+class _BloomSlice():
+    """One fixed size Bloom filter in a memory-mapped file
+
+    The first page is the header, the bits follow. Pages touched since the
+    last `flush` are remembered and only those are written back.
+    """
+
+    MAGIC = b"BLOOMv1\0"
+    HEADER = struct.Struct("<8sQIQQ")  # magic, m (bits), k, capacity, count
+    PAGE = mmap.ALLOCATIONGRANULARITY
+
+    def __init__(self, path, capacity=None, error_rate=None):
+        self.path = path
+        if not path.exists():
+            m = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+            k = max(1, round(m / capacity * math.log(2)))
+            size = self.PAGE + math.ceil(m / 8 / self.PAGE) * self.PAGE
+            with path.open("wb") as f:
+                f.truncate(size)  # sparse, nothing is written
+                f.write(self.HEADER.pack(self.MAGIC, m, k, capacity, 0))
+
+        self._file = path.open("r+b")
+        self.mm = mmap.mmap(self._file.fileno(), 0)
+        magic, self.m, self.k, self.capacity, self.count = \
+            self.HEADER.unpack_from(self.mm)
+        assert magic == self.MAGIC, path
+        self.dirty = set()
+        self.bits = numpy and numpy.frombuffer(self.mm, numpy.uint8, offset=self.PAGE)
+
+    def positions(self, h1, h2):
+        m = self.m
+        return [((h1 + i * h2) & MASK64) % m for i in range(self.k)]
+
+    def positions_many(self, h):
+        """h: (n, 2) uint64 -> (n, k), the same as `positions`, uint64 wraps"""
+        i = numpy.arange(self.k, dtype=numpy.uint64)
+        return (h[:, :1] + i * h[:, 1:]) % numpy.uint64(self.m)
+
+    def contains_many(self, h):
+        pos = self.positions_many(h)
+        bit = numpy.left_shift(1, pos & 7).astype(numpy.uint8)
+        return (self.bits[pos >> 3] & bit).all(axis=1)
+
+    def add_many(self, h):
+        pos = self.positions_many(h).ravel()
+        byte = pos >> 3
+        numpy.bitwise_or.at(self.bits, byte, numpy.left_shift(1, pos & 7).astype(numpy.uint8))
+        self.dirty.update((numpy.unique(byte // self.PAGE) + 1).tolist())
+        self.count += len(h)
+        struct.pack_into("<Q", self.mm, self.HEADER.size - 8, self.count)
+        self.dirty.add(0)
+
+    def contains(self, h1, h2):
+        mm, offset = self.mm, self.PAGE
+        return all(mm[offset + (i >> 3)] & (1 << (i & 7))
+                   for i in self.positions(h1, h2))
+
+    def add(self, h1, h2):
+        mm, offset = self.mm, self.PAGE
+        for i in self.positions(h1, h2):
+            byte = offset + (i >> 3)
+            mm[byte] |= 1 << (i & 7)
+            self.dirty.add(byte // self.PAGE)
+        self.count += 1
+        struct.pack_into("<Q", mm, self.HEADER.size - 8, self.count)
+        self.dirty.add(0)
+
+    def flush(self):
+        pages = sorted(self.dirty)
+        self.dirty.clear()
+        start = prev = None
+        for page in pages + [None]:
+            if page is not None and prev is not None and page == prev + 1:
+                prev = page
+                continue
+            if start is not None:
+                self.mm.flush(start * self.PAGE, (prev - start + 1) * self.PAGE)
+            start = prev = page
+
+    def clear(self):
+        self.mm[:] = bytes(len(self.mm))
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.m, self.k, self.capacity, 0)
+        self.count = 0
+        self.mm.flush()
+
+    def close(self):
+        self.flush()
+        self.bits = None  # or mmap refuses to close
+        self.mm.close()
+        self._file.close()
+
+
+class BloomFilter():
+    """Scalable Bloom filter (Almeida et al., 2007) in memory-mapped files
+
+    `folder`/0 holds `capacity` keys at `error_rate`. When a slice is full,
+    the next one holds twice as many keys at half the error rate, so the
+    total false positive rate stays under `error_rate`. Opening is instant
+    and only the pages actually touched become resident.
+
+    The k bit positions of a key come from one 128-bit BLAKE2b digest,
+    h1 + i * h2 (Kirsch & Mitzenmacher, 2006).
+
+    >>> import tempfile
+    >>> bf = BloomFilter(tempfile.mkdtemp(), capacity=100, error_rate=0.01)
+    >>> bf.set("q.org"), bf.set("q.org"), bf.exists("q.org"), bf.exists("q.net")
+    (True, False, True, False)
+    >>> for i in range(1000):
+    ...     _ = bf.set(str(i))
+    >>> len(bf.slices), 990 < len(bf) <= 1001
+    (4, True)
+    >>> bf.close()
+    >>> len(BloomFilter(bf.folder, capacity=100, error_rate=0.01)) == len(bf)
+    True
+
+    With NumPy, `exists_many` / `set_many` do the same for many keys at once:
+
+    >>> bf = BloomFilter(tempfile.mkdtemp(), capacity=100, error_rate=0.01)
+    >>> bf.set_many(["a.org", "b.org", "a.org"]).tolist()
+    [True, True, False]
+    >>> bf.exists_many(["a.org", "c.org"]).tolist(), bf.exists("b.org")
+    ([True, False], True)
+    """
+
+    GROWTH = 2
+    TIGHTENING = 0.5
+
+    def __init__(self, folder, capacity=100 * 1000 * 1000, error_rate=0.001):
         self.folder = pathlib.Path(folder)
         if not self.folder.exists():
             self.folder.mkdir()
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self.slices = []
+        for idx in itertools.count():
+            if not (self.folder / str(idx)).exists():
+                break
+            self.slices.append(_BloomSlice(self.folder / str(idx)))
+        if not self.slices:
+            self._grow()
+
+    def __len__(self):
+        return sum(s.count for s in self.slices)
+
+    def _grow(self):
+        idx = len(self.slices)
+        self.slices.append(_BloomSlice(
+            self.folder / str(idx),
+            self.capacity * self.GROWTH ** idx,
+            self.error_rate * (1 - self.TIGHTENING) * self.TIGHTENING ** idx,
+        ))
+
+    @staticmethod
+    def _hash(key):
+        if isinstance(key, str):
+            key = key.encode()
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little")
 
-        self.bitarrays = []
-        for idx in map(str, range(self.NUM_OF_BITARRAY)):
-            fn = self.folder / idx
-            if fn.exists():
-                with fn.open("rb") as f:
-                    ba = bitarray.bitarray()
-                    ba.fromfile(f)
-                    assert ba.length() == self.BITARRAY_LENGTH
-            else:
-                ba = bitarray.bitarray(self.BITARRAY_LENGTH)
-                ba.setall(0)
-            self.bitarrays.append(ba)
-        assert len(self.bitarrays) == self.NUM_OF_BITARRAY
+    @staticmethod
+    def _hash_many(keys):
+        digests = b"".join(
+            hashlib.blake2b(key.encode() if isinstance(key, str) else key,
+                            digest_size=16).digest()
+            for key in keys)
+        return numpy.frombuffer(digests, "<u8").reshape(-1, 2).astype(numpy.uint64)
 
-    def save(self):
-        threading.Thread(target=self._save).start()
+    def exists(self, key) -> bool:
+        h = self._hash(key)
+        return any(s.contains(*h) for s in self.slices)
 
-    def _save(self):
-        for idx, ba in enumerate(self.bitarrays):
-            with (self.folder / str(idx)).open("wb") as f:
-                ba.tofile(f)
+    def _exists_many(self, h):
+        found = numpy.zeros(len(h), bool)
+        for s in self.slices:
+            found |= s.contains_many(h)
+        return found
 
-    def exists(self, key) -> bool:
-        if isinstance(key, str):
-            key = key.encode()
-        return all(self.bitarrays[idx][offset]
-                   for idx, offset in enumerate(self._hash_values(key)))
+    def exists_many(self, keys):
+        """-> numpy bool array, one per key"""
+        return self._exists_many(self._hash_many(keys))
 
-    def set(self, key):
-        """set to true"""
-        if isinstance(key, str):
-            key = key.encode()
-        for idx, offset in enumerate(self._hash_values(key)):
-            self.bitarrays[idx][offset] = True
+    def set_many(self, keys):
+        """-> numpy bool array, True for keys that were not there
+
+        A key repeated in `keys` is new only the first time.
+        """
+
+        h = self._hash_many(keys)
+        new = ~self._exists_many(h)
+        first = numpy.zeros(len(h), bool)
+        first[numpy.unique(h, axis=0, return_index=True)[1]] = True
+        new &= first
+
+        idx = numpy.flatnonzero(new)
+        while len(idx):
+            last = self.slices[-1]
+            room = last.capacity - last.count
+            last.add_many(h[idx[:room]])
+            idx = idx[room:]
+            if last.count >= last.capacity:
+                self._grow()
+        return new
+
+    def set(self, key) -> bool:
+        """set to true, False if it was there already"""
+        h = self._hash(key)
+        if any(s.contains(*h) for s in self.slices):
+            return False
+        last = self.slices[-1]
+        last.add(*h)
+        if last.count >= last.capacity:
+            self._grow()
+        return True
 
-    def _hash_values(self, key):
-        md5 = hashlib.md5(key).digest()
-        from_bytes = int.from_bytes
-        for idx in range(self.NUM_OF_BITARRAY):
-            i, j = idx * 4, (idx + 1) * 4
-            yield from_bytes(md5[i:j], "big")
+    def save(self):
+        for s in self.slices:
+            s.flush()
 
     def clear(self):
-        for ba in self.bitarrays:
-            ba.setall(0)
+        for s in self.slices[1:]:
+            s.close()
+            s.path.unlink()
+        del self.slices[1:]
+        self.slices[0].clear()
 
     def close(self):
-        self.save()
+        for s in self.slices:
+            s.close()
 
 
 class RecordedText():
@@ -150,10 +331,12 @@ class Tasks():
         return task
 
     def add(self, *tasks):
-        tasks = set(t for t in tasks if t not in self.set)
-        self.set.add(*tasks)
-        for t in tasks:
-            self.text.write(t)
+        tasks = list(dict.fromkeys(tasks))
+        tasks = [t for t, existed in zip(tasks, self.set.contains_many(tasks))
+                 if not existed]
+        if tasks:
+            self.set.add_many(tasks)
+            self.text.write("\n".join(tasks))
         return len(tasks)
 
     def close(self):
@@ -208,9 +391,37 @@ def init():
     t.close()
 
 
+def bench(n=200000):
+    """./tasks_publisher.py bench [n]"""
+
+    import tempfile
+
+    n = int(n)
+    keys = ["www.{}.com".format(i) for i in range(n)]
+    others = ["www.{}.net".format(i) for i in range(n)]
+    for name in ["per key", "batched"]:
+        bf = BloomFilter(tempfile.mkdtemp(), capacity=n, error_rate=0.001)
+        t = time.time()
+        if name == "batched":
+            bf.set_many(keys)
+            t_set = time.time() - t
+            fp = bf.exists_many(others).sum()
+        else:
+            for key in keys:
+                bf.set(key)
+            t_set = time.time() - t
+            fp = sum(map(bf.exists, others))
+        t_all = time.time() - t
+        print("{}: set {:.2f}s, exists {:.2f}s, {} false positives".format(
+            name, t_set, t_all - t_set, fp))
+        bf.close()
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         if sys.argv[1] == "init":
             init()
+        elif sys.argv[1] == "bench":
+            bench(*sys.argv[2:])
     else:
         test()
@@ -0,0 +1,235 @@
+"""HostInfoHandler._ingest, run on the ingest executor like the hub does,
+and POST /host-info, with in-memory stand-ins for Redis and LevelDB.
+"""
+
+import collections
+import collections.abc
+import json
+import os
+import sys
+import types
+import unittest
+
+if not hasattr(collections, "MutableMapping"):  # Tornado 5 on Python 3.10+
+    collections.MutableMapping = collections.abc.MutableMapping
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.testing
+import tornado.web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakePipeline():
+    def __init__(self, redis_cli):
+        self.redis_cli = redis_cli
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        return lambda *args: self.commands.append((name, args))
+
+    def execute(self):
+        self.redis_cli.executed.extend(self.commands)
+        replies = [set() if name == "smembers" else 0 for name, _ in self.commands]
+        self.commands = []
+        return replies
+
+
+class FakeRedis():
+    def __init__(self, *args, **kwargs):
+        self.executed = []
+
+    def script_load(self, script):
+        return "sha{}".format(hash(script))
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def __getattr__(self, name):
+        return lambda *args: self.executed.append((name, args))
+
+
+class FakeWriteBatch():
+    def __init__(self):
+        self.puts = []
+
+    def Put(self, k, v):
+        self.puts.append((k, v))
+
+
+class FakeLevelDB():
+    def __init__(self, path):
+        self.data = {}
+
+    def Get(self, k):
+        return self.data[k]
+
+    def Write(self, batch):
+        self.data.update(batch.puts)
+
+
+def _stub_modules():
+    sys.modules["redis"] = types.SimpleNamespace(StrictRedis=FakeRedis)
+    sys.modules["leveldb"] = types.SimpleNamespace(LevelDB=FakeLevelDB, WriteBatch=FakeWriteBatch)
+    sys.modules.setdefault("bs4", types.ModuleType("bs4"))
+    cz88_ip = types.ModuleType("cz88_ip")
+    cz88_ip.find = lambda ip: "somewhere"
+    sys.modules.setdefault("cz88_ip", cz88_ip)
+
+
+def _hub():
+    os.chdir(ROOT)  # public_suffix_list.dat
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    _stub_modules()
+    import hub
+
+    hub.BaseHandler.open_shard(0, [1033])
+    hub.BaseHandler.aredis = hub.AsyncRedis(hub.BaseHandler.redis_cli)
+    hub.BaseHandler.redis_cli.executed = []
+    hub.HostInfoHandler.exporter = None
+    hub.HostInfoHandler.pending = 0
+    hub.TailHandler._todos.clear()
+    hub.TailHandler._todos["t"] = []
+    return hub
+
+
+class IngestTest(unittest.TestCase):
+    def test_ingest_on_executor(self):
+        hub = _hub()
+        hub.HostInfoHandler.known_tail_names.add("q.com")
+        redis_cli = hub.BaseHandler.redis_cli
+
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+        hub.TailHandler.io_loop = io_loop
+
+        info = {"ip": "1.2.3.4", "pages": [{"code": 200, "title": "t"}],
+                "other_hosts_found": ["www.q.com"]}
+        handler = object.__new__(hub.HostInfoHandler)
+
+        @tornado.gen.coroutine
+        def run():
+            yield hub.HostInfoHandler.executor.submit(
+                handler._ingest, [("a.org", json.dumps(info).encode())])
+            yield tornado.gen.moment  # the tail log, handed over to the IOLoop
+
+        io_loop.run_sync(run)
+        io_loop.close()
+
+        record = hub.BaseHandler.db.data[b"a.org"]
+        self.assertTrue(record.startswith(hub.codec.MAGIC))
+        self.assertEqual(json.loads(hub.codec.decode(record).decode()), info)
+
+        names = [name for name, _ in redis_cli.executed]
+        self.assertIn("evalsha", names)  # add_hosts for www.q.com
+        self.assertIn(("zrem", ("leases", "a.org")), redis_cli.executed)
+        self.assertEqual(hub.BaseHandler.aredis.unflushed("cnt", "done"), 1)
+        self.assertEqual([i["host"] for i in hub.TailHandler._todos["t"]], ["a.org"])
+
+    def test_flush_waits_for_the_one_in_flight(self):
+        hub = _hub()
+        aredis = hub.AsyncRedis(FakeRedis())
+
+        @tornado.gen.coroutine
+        def run():
+            aredis.hincrby("cnt", "done", 1)
+            periodic = aredis.flush_incrs()
+            aredis.hincrby("cnt", "done", 2)  # from an ingest, meanwhile
+            yield aredis.flush_incrs(wait=True)
+            self.assertTrue(periodic.done())
+
+        io_loop = tornado.ioloop.IOLoop()
+        io_loop.make_current()
+        io_loop.run_sync(run)
+        io_loop.close()
+
+        self.assertEqual(aredis.unflushed("cnt", "done"), 0)
+        self.assertEqual(aredis.redis_cli.executed,
+                         [("hincrby", ("cnt", "done", 1)), ("hincrby", ("cnt", "done", 2))])
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = _hub()
+        self.io_loop = tornado.ioloop.IOLoop()
+        self.io_loop.make_current()
+        self.hub.TailHandler.io_loop = self.io_loop
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server = tornado.httpserver.HTTPServer(tornado.web.Application(self.hub.handlers))
+        self.server.add_sockets([sock])
+
+    def tearDown(self):
+        self.server.stop()
+        self.io_loop.close(all_fds=True)
+
+    def fetch(self, path, **kwargs):
+        url = "http://127.0.0.1:{}{}".format(self.port, path)
+        return self.io_loop.run_sync(lambda: tornado.httpclient.AsyncHTTPClient().fetch(
+            url, raise_error=False, **kwargs))
+
+    def post(self, path, body, headers=None):
+        return self.fetch(path, method="POST", body=body, headers=headers)
+
+    def assertIngested(self, names):
+        hub = self.hub
+        self.assertEqual(sorted(k.decode() for k in hub.BaseHandler.db.data), sorted(names))
+        self.assertEqual(hub.BaseHandler.aredis.unflushed("cnt", "done"), len(names))
+        acked = [args for name, args in hub.BaseHandler.redis_cli.executed if name == "zrem"]
+        self.assertEqual(acked, [("leases", *names)] if names else [])
+
+    def test_lines(self):
+        codec = self.hub.codec
+        body = b"a.org\t{}\nb.org\t{not json\n\nc.org\t{}\n"
+        resp = self.post("/host-info", body.replace(b"{}\nc", codec.encode(b"{}") + b"\nc"))
+        self.assertEqual(resp.code, 200)
+        self.assertIngested(["a.org", "c.org"])
+
+    def test_records(self):
+        codec = self.hub.codec
+        no_zdict = codec.MAGIC + bytes([codec.VERSION, 255]) + b"x"
+        body, headers = codec.batch([("a.org", codec.encode(b"{}")), ("b.org", no_zdict),
+                                     ("c.org", b'{"pages": []}'), ("d.org", b"[]")])
+        resp = self.post("/host-info", body + b"e.org\t99\n{}", headers)
+        self.assertEqual(resp.code, 200)
+        self.assertIngested(["a.org", "c.org"])
+
+    def test_forward(self):
+        hub = self.hub
+        broken = tornado.httpserver.HTTPServer(tornado.web.Application(
+            [(r"/host-info", tornado.web.ErrorHandler, {"status_code": 500})]))
+        sock, broken_port = tornado.testing.bind_unused_port()
+        broken.add_sockets([sock])
+        sock, down_port = tornado.testing.bind_unused_port()
+        sock.close()
+        hub.BaseHandler.open_shard(0, [self.port, down_port, broken_port])
+
+        records = [("h{}.com".format(i), b"{}") for i in range(30)]
+        shards = collections.defaultdict(list)
+        for name, content in records:
+            shards[hub.BaseHandler.ring.get(name)].append((name, content))
+        self.assertEqual(len(shards), 3)
+
+        resp = self.post("/host-info", *hub.codec.batch(records))
+        broken.stop()
+        self.assertEqual(resp.code, 200)
+        self.assertEqual(hub.codec.resend(records, resp.code, resp.body), shards[1])
+        self.assertIngested([name for name, _ in shards[0]])
+
+    def test_bad_n(self):
+        self.assertEqual(self.fetch("/host?n=abc").code, 400)
+
+    def test_one_bad(self):
+        resp = self.post("/host-info/b.org", b"{not json")
+        self.assertEqual(resp.code, 400)
+        self.assertIngested([])
+
+
+if __name__ == "__main__":
+    unittest.main()